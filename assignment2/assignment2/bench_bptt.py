@@ -0,0 +1,68 @@
+import sys
+import time
+import numpy as np
+import pandas as pd
+from nn.math import sigmoidGrad, make_onehot
+from data_utils import utils as du
+from rnnlm import RNNLM
+
+# Time of RNNLM._acc_grads on PTB sentences at hdim=150, bptt=4:
+# the old per-step diag/ones products against the outer-product BPTT.
+# ptb-train.txt is not shipped, so this uses the dev set.
+# Usage: python bench_bptt.py [numSentences]
+
+class DiagRNNLM(RNNLM):
+    """The previous BPTT, building each outer product from dense diags."""
+
+    def _acc_grads(self, xs, ys):
+        ns = len(xs)
+        hs = np.zeros((ns+1, self.hdim))
+        ps = np.zeros((ns+1, self.vdim))
+        zs = np.zeros((ns+1,self.hdim))
+        for i in range(ns):
+            zs[i+1] = self.params.H.dot(hs[i]) + self.params.W.dot(self.sparams.L[xs[i]])
+            hs[i+1] = 1.0/(1.0 + np.exp(-zs[i+1]))
+            ps[i+1] = np.exp(self.params.U.dot(hs[i+1]))
+            ps[i+1] /= np.sum(ps[i+1])
+        sgradsTmp = np.zeros((self.vdim,self.hdim))
+        for i in range(ns):
+            dy = ps[i+1]-make_onehot(ys[i],self.vdim)
+            self.grads.U += np.outer(dy,hs[i+1])
+            vectorCurrent = dy.dot(self.params.U)*sigmoidGrad(zs[i+1])
+            for j in range(min(i+1,self.bptt+1)):
+                xh1 = np.ones((self.hdim, self.hdim)).dot(np.diag(hs[i-j]))
+                self.grads.H += np.diag(vectorCurrent).dot(xh1)
+                x1 = np.ones((self.hdim, self.hdim)).dot(np.diag(self.sparams.L[xs[i-j]]))
+                self.grads.W += np.diag(vectorCurrent).dot(x1)
+                sgradsTmp[xs[i-j]] += vectorCurrent.dot(self.params.W)
+                vectorCurrent = vectorCurrent.dot(self.params.H)*sigmoidGrad(zs[i-j])
+        self.grads.U += self.lreg*self.params.U
+        self.grads.H += self.lreg*self.params.H
+        self.grads.W += self.lreg*self.params.W
+        for i in range(len(sgradsTmp)):
+            self.sgrads.L[i] = sgradsTmp[i,:]
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    vocab = pd.read_table("data/lm/vocab.ptb.txt",header=None, sep="\s+", index_col=0, names=['count','freq'])
+    vocabsize = 2000
+    num_to_word = dict(enumerate(vocab.index[:vocabsize]))
+    word_to_num = du.invert_dict(num_to_word)
+    docs = du.load_dataset('data/lm/ptb-dev.txt')
+    X, Y = du.seqs_to_lmXY(du.docs_to_indices(docs[:n], word_to_num))
+
+    hdim, bptt = 150, 4
+    np.random.seed(10)
+    L0 = 0.1*np.random.randn(vocabsize,hdim)
+    grads = []
+    for cls in [DiagRNNLM, RNNLM]:
+        model = cls(L0, U0=L0, alpha=0.1, rseed=10, bptt=bptt)
+        model.grads.reset()
+        start = time.time()
+        for xs,ys in zip(X,Y):
+            model.sgrads.reset()
+            model._acc_grads(xs,ys)
+        print "%s: %.2fs for %d sentences (%d words)"%(
+            cls.__name__,time.time()-start,len(X),sum(map(len,Y)))
+        grads.append(model.grads.full.copy())
+    print "max difference of dense grads: %.2e"%np.abs(grads[0]-grads[1]).max()
@@ -0,0 +1,58 @@
+import sys
+import time
+import numpy as np
+from nn.math import softmax, sigmoid, make_onehot, multinomial_sample
+from rnnlm import RNNLM, RNNLMDecoder
+
+# Sequences generated per second at hdim=150 by the old generate_sequence
+# (one sampler and one-hot vector per token) against RNNLMDecoder,
+# sampling many sequences as one batch, and beam search.
+# Usage: python bench_decode.py [numSequences] [vocabsize]
+
+class OldRNNLM(RNNLM):
+    """The previous generate_sequence."""
+
+    def generate_sequence(self, init, end, maxlen=100):
+        J = 0
+        ys = [init]
+        hs = np.zeros((maxlen+1,self.hdim))
+        for i in range(maxlen):
+            hs[i+1] = sigmoid(self.params.H.dot(hs[i])+self.params.W.dot(self.sparams.L[ys[i]]))
+            p = softmax(self.params.U.dot(hs[i+1]))
+            y = multinomial_sample(p)
+            ys.append(y)
+            if y == end:
+                break
+            p = p*make_onehot(y,self.vdim)
+            J += -np.log(np.sum(p))
+        return ys, J
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    vocabsize = int(sys.argv[2]) if len(sys.argv) > 2 else 6000
+    hdim, init, end, maxlen = 150, 0, 1, 30
+    np.random.seed(10)
+    L0 = 0.1*np.random.randn(vocabsize,hdim)
+    model = OldRNNLM(L0, U0=L0, alpha=0.1, rseed=10)
+    decoder = RNNLMDecoder(model)
+
+    start = time.time()
+    ntok = sum(len(model.generate_sequence(init, end, maxlen)[0]) for _ in xrange(n))
+    elapsed = time.time()-start
+    print "generate_sequence: %.1f sequences/sec (%.0f tokens/sec)"%(n/elapsed, ntok/elapsed)
+
+    for batch in [10, 100]:
+        start = time.time()
+        ntok = 0
+        for _ in xrange(n//batch):
+            seqs, J = decoder.sample(init, end, n=batch, maxlen=maxlen)
+            ntok += sum(map(len,seqs))
+        elapsed = time.time()-start
+        print "decoder.sample n=%d: %.1f sequences/sec (%.0f tokens/sec)"%(
+            batch, batch*(n//batch)/elapsed, ntok/elapsed)
+
+    for width in [1, 5]:
+        start = time.time()
+        for _ in xrange(10):
+            decoder.beam_search(init, end, width=width, maxlen=maxlen)
+        print "decoder.beam_search width=%d: %.1f searches/sec"%(width, 10/(time.time()-start))
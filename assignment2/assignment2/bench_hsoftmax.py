@@ -0,0 +1,44 @@
+import sys
+import time
+import numpy as np
+import pandas as pd
+from data_utils import utils as du
+from rnnlmWithHierarchicalSoftmax import ExtensionRNNLM
+
+# ExtensionRNNLM with the balanced tree against the Huffman tree built
+# from the vocab.ptb.txt counts: expected path length per token, training
+# tokens/sec and dev perplexity after one SGD pass over the same sentences.
+# ptb-train.txt is not shipped, so this trains on the start of the dev set
+# and evaluates on the rest of it.
+# Usage: python bench_hsoftmax.py [numTrain] [numDev] [hdim]
+
+if __name__ == "__main__":
+    ntrain = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    ndev = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    hdim = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+    vocab = pd.read_table("data/lm/vocab.ptb.txt",header=None, sep="\s+", index_col=0, names=['count','freq'])
+    vocabsize = len(vocab)
+    num_to_word = dict(enumerate(vocab.index[:vocabsize]))
+    word_to_num = du.invert_dict(num_to_word)
+    docs = du.load_dataset('data/lm/ptb-dev.txt')
+    X, Y = du.seqs_to_lmXY(du.docs_to_indices(docs, word_to_num))
+    X_train, Y_train = X[:ntrain], Y[:ntrain]
+    X_dev, Y_dev = X[ntrain:ntrain+ndev], Y[ntrain:ntrain+ndev]
+    ntokens = sum(map(len,Y_train))
+    counts = np.array(vocab['count'][:vocabsize])
+
+    for name, c in [('balanced',None),('huffman',counts)]:
+        np.random.seed(10)
+        L0 = 0.1*np.random.randn(vocabsize,hdim)
+        model = ExtensionRNNLM(L0, U0=L0, alpha=0.1, rseed=10, bptt=3, counts=c)
+        tree = model.hierarchicalU
+        depth = np.diff(tree.offsets)
+        start = time.time()
+        for xs,ys in zip(X_train,Y_train):
+            model.train_point_sgd(xs,ys,alpha=0.1)
+        elapsed = time.time()-start
+        J, _ = model.compute_batch_loss(X_dev,Y_dev)
+        dev_loss = J/float(sum(map(len,Y_dev)))
+        print "%s: mean path %.2f per token (max %d), %.0f tokens/sec, dev perplexity %.1f"%(
+            name,counts.dot(depth)/float(counts.sum()),depth.max(),
+            ntokens/elapsed,np.exp(dev_loss))
@@ -0,0 +1,49 @@
+import sys
+import time
+import numpy as np
+import pandas as pd
+from data_utils import utils as du
+from rnnlm import RNNLM
+
+# Training tokens/sec of RNNLM at hdim=150, bptt=4: one _acc_grads pass
+# per sentence against padded length-bucketed minibatches run as one
+# batch, and the largest difference between the two summed gradients.
+# ptb-train.txt is not shipped, so this uses the dev set.
+# Usage: python bench_minibatch.py [numSentences] [vocabsize]
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    vocabsize = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    vocab = pd.read_table("data/lm/vocab.ptb.txt",header=None, sep="\s+", index_col=0, names=['count','freq'])
+    num_to_word = dict(enumerate(vocab.index[:vocabsize]))
+    word_to_num = du.invert_dict(num_to_word)
+    docs = du.load_dataset('data/lm/ptb-dev.txt')
+    X, Y = du.seqs_to_lmXY(du.docs_to_indices(docs[:n], word_to_num))
+    ntokens = sum(map(len,Y))
+
+    hdim, bptt = 150, 4
+    np.random.seed(10)
+    L0 = 0.1*np.random.randn(vocabsize,hdim)
+    model = RNNLM(L0, U0=L0, alpha=0.1, rseed=10, bptt=bptt)
+
+    for batch in [1, 5, 20, 50]:
+        np.random.seed(10)
+        batches = list(model.bucketiter(map(len,Y), batch))
+        start = time.time()
+        for idx in batches:
+            model._reset_grad_acc()
+            if batch == 1:
+                model._acc_grads(X[idx[0]], Y[idx[0]])
+            else:
+                model._acc_batch_grads(X[idx], Y[idx])
+        elapsed = time.time()-start
+        print "minibatch %2d: %.0f tokens/sec"%(batch, ntokens/elapsed)
+
+    idx = batches[0]
+    model._reset_grad_acc()
+    for i in idx:
+        model._acc_grads(X[i], Y[i])
+    ref = model.grads.full.copy()
+    model._reset_grad_acc()
+    model._acc_batch_grads(X[idx], Y[idx])
+    print "max difference of dense grads: %.2e"%np.abs(ref-model.grads.full).max()
@@ -0,0 +1,56 @@
+import sys
+import time
+import numpy as np
+import data_utils.utils as du
+from nn.math import softmax, make_onehot
+from nerwindow import WindowMLP
+
+# WindowMLP training throughput on data/ner/train windows: the previous
+# one-window-at-a-time _acc_grads looped over each minibatch, against
+# the batched _acc_grads, at minibatch sizes 5 to 256. wordVectors.txt
+# is not shipped, so the 50-d word vectors are random.
+# Usage: python bench_nerwindow.py [numWindows]
+
+class LoopWindowMLP(WindowMLP):
+    """The previous _acc_grads, one window per call."""
+
+    def _acc_grads(self, window, label):
+        x = np.concatenate([self.sparams.L[w] for w in window])
+        z = self.params.W.dot(x)+self.params.b1
+        h = self.tanh(z)
+        y = make_onehot(label,self.params.b2.shape[0])
+        yP = softmax(self.params.U.dot(h)+self.params.b2)
+        self.grads.U += np.outer(yP-y,h) + self.lreg*self.params.U
+        self.grads.b2 += yP-y
+        self.grads.W += np.outer((self.params.U.T.dot(yP-y)*self.tanhGrad(z)),x) + self.lreg*self.params.W
+        self.grads.b1 += self.params.U.T.dot(yP-y)*self.tanhGrad(z)
+        gL = self.params.W.T.dot(self.params.U.T.dot(yP-y)*self.tanhGrad(z))
+        for i in range(len(window)):
+            self.sgrads.L[window[i]] = gL[len(gL)*i/len(window):len(gL)*(i+1)/len(window)]
+
+    def train_minibatch_sgd(self, X, y, alpha):
+        self._reset_grad_acc()
+        for i in range(len(y)):
+            self._acc_grads(X[i], y[i])
+        self._apply_grad_acc(alpha)
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    with open('data/ner/vocab.txt') as fd:
+        word_to_num = du.invert_dict(dict(enumerate(line.strip() for line in fd)))
+    tag_to_num = du.invert_dict(dict(enumerate(["O", "LOC", "MISC", "ORG", "PER"])))
+    X, y = du.docs_to_windows(du.load_dataset('data/ner/train'), word_to_num, tag_to_num, 3)
+    X, y = X[:n], y[:n]
+    np.random.seed(10)
+    wv = np.random.randn(len(word_to_num), 50)
+
+    for batch in [5, 20, 64, 256]:
+        rates = []
+        for cls in [LoopWindowMLP, WindowMLP]:
+            clf = cls(wv, windowsize=3, dims=[None,100,5], reg=0.001, alpha=0.01)
+            start = time.time()
+            for i in xrange(0, len(y)-batch+1, batch):
+                clf.train_minibatch_sgd(X[i:i+batch], y[i:i+batch], clf.alpha)
+            rates.append(len(y)/(time.time()-start))
+        print "minibatch %3d: loop %.0f windows/sec, batched %.0f windows/sec"%(
+            batch, rates[0], rates[1])
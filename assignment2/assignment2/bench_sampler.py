@@ -0,0 +1,38 @@
+import sys
+import time
+import numpy as np
+import pandas as pd
+from nn.math import MultinomialSampler, AliasSampler, alias_sampler
+
+# Sampling from the PTB unigram distribution (vocab.ptb.txt): the
+# cumsum/searchsorted MultinomialSampler against the alias table, for
+# one bulk draw of n words and for n/100 draws of 100 (the negative
+# sampling pattern), plus the largest error of the sampled frequencies.
+# Usage: python bench_sampler.py [n]
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10**6
+    vocab = pd.read_table("data/lm/vocab.ptb.txt",header=None, sep="\s+", index_col=0, names=['count','freq'])
+    p = vocab['count'].values.astype(float)
+    p /= p.sum()
+
+    for name, cls in [('cumsum', MultinomialSampler), ('alias', AliasSampler)]:
+        np.random.seed(10)
+        start = time.time()
+        sampler = cls(p)
+        setup = time.time()-start
+        start = time.time()
+        draws = sampler.sample(n)
+        bulk = time.time()-start
+        start = time.time()
+        for _ in xrange(n//100):
+            sampler.sample(100)
+        small = time.time()-start
+        err = np.abs(np.bincount(draws, minlength=len(p))/float(n) - p).max()
+        print "%s: set-up %.1fms, %d draws %.1fms, %d x 100 draws %.1fms (max freq error %.1e)"%(
+            name, 1000*setup, n, 1000*bulk, n//100, 1000*small, err)
+
+    start = time.time()
+    for _ in xrange(1000):
+        alias_sampler(p).sample(1)
+    print "cached alias_sampler: %.3fms per call"%(time.time()-start)
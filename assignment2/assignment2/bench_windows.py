@@ -0,0 +1,36 @@
+import sys
+import time
+import numpy as np
+import data_utils.utils as du
+
+# Time to build the NER training windows from data/ner/train: the old
+# per-token list comprehension of seq_to_windows against the strided
+# view of docs_to_windows, for a few window sizes.
+# Usage: python bench_windows.py [dataset]
+
+def listWindows(docs, word_to_num, tag_to_num, wsize=3):
+    """The previous docs_to_windows."""
+    pad = (wsize - 1)/2
+    docs = du.flatten1([du.pad_sequence(seq, left=pad, right=pad) for seq in docs])
+    words, tags = zip(*docs)
+    words = [du.canonicalize_word(w, word_to_num) for w in words]
+    tags = [t.split("|")[0] for t in tags]
+    return du.seq_to_windows(words, tags, word_to_num, tag_to_num, pad, pad)
+
+if __name__ == "__main__":
+    fname = sys.argv[1] if len(sys.argv) > 1 else 'data/ner/train'
+    with open('data/ner/vocab.txt') as fd:
+        word_to_num = du.invert_dict(dict(enumerate(line.strip() for line in fd)))
+    tag_to_num = du.invert_dict(dict(enumerate(["O", "LOC", "MISC", "ORG", "PER"])))
+    docs = du.load_dataset(fname)
+
+    for wsize in [3, 5, 7]:
+        start = time.time()
+        X0, y0 = listWindows(docs, word_to_num, tag_to_num, wsize)
+        t0 = time.time()-start
+        start = time.time()
+        X1, y1 = du.docs_to_windows(docs, word_to_num, tag_to_num, wsize)
+        t1 = time.time()-start
+        same = np.array_equal(X0, X1) and np.array_equal(y0, y1)
+        print "wsize %d: %d windows, list %.2fs, strided %.2fs (same: %s)"%(
+            wsize, len(y1), t0, t1, same)
@@ -3,10 +3,20 @@
 # Assigment 2, part 1 for CS224D
 ##
 
+import itertools
 from utils import invert_dict
 from numpy import *
+import numpy as np
 
 def load_wv(vocabfile, wvfile):
+    """
+    Loads the vocabulary and word vectors. If wvfile is a .npy written
+    by convert_wv, the vectors are memory-mapped (read-only, shared
+    between processes) and the words come from the files next to it,
+    so vocabfile is not read.
+    """
+    if wvfile.endswith(".npy"):
+        return load_wv_binary(wvfile[:-len(".npy")])
     wv = loadtxt(wvfile, dtype=float)
     with open(vocabfile) as fd:
         words = [line.strip() for line in fd]
@@ -14,6 +24,81 @@ def load_wv(vocabfile, wvfile):
     word_to_num = invert_dict(num_to_word)
     return wv, word_to_num, num_to_word
 
+##
+# Binary word vectors, written once by convert_wv to
+#   prefix.npy          the |V| x n vectors
+#   prefix.words        the words, one per line
+#   prefix.offsets.npy  byte offset of every word in prefix.words, and the end
+
+def convert_wv(vocabfile, wvfile, outfile):
+    """Converts text vocabulary and word vector files for load_wv."""
+    assert outfile.endswith(".npy")
+    prefix = outfile[:-len(".npy")]
+    with open(vocabfile) as fd:
+        words = [line.strip() for line in fd]
+    wv = loadtxt(wvfile, dtype=float)
+    assert wv.shape[0] == len(words)
+    np.save(outfile, wv)
+    with open(prefix + ".words", "w") as fd:
+        fd.write("\n".join(words))
+    lens = np.array([len(w) + 1 for w in words], dtype=np.int64)
+    np.save(prefix + ".offsets.npy", np.concatenate([[0], np.cumsum(lens)]))
+
+class WordList(object):
+    """
+    num_to_word of a binary vocabulary: word i is read from the
+    memory-mapped words file on access.
+    """
+
+    def __init__(self, prefix):
+        self.data = np.memmap(prefix + ".words", dtype=np.uint8, mode="r")
+        self.offsets = np.load(prefix + ".offsets.npy", mmap_mode="r")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i+1]-1].tostring()
+
+    def words(self):
+        return self.data.tostring().split("\n")
+
+class LazyWordToNum(object):
+    """
+    word_to_num of a binary vocabulary, as a dict built on first use.
+    Other dict methods (get, iteritems, ...) go to that dict.
+    """
+
+    def __init__(self, wordlist):
+        self.wordlist = wordlist
+        self._dict = None
+
+    def todict(self):
+        if self._dict is None:
+            self._dict = dict(itertools.izip(self.wordlist.words(), itertools.count()))
+        return self._dict
+
+    def __getitem__(self, word):
+        return self.todict()[word]
+
+    def __contains__(self, word):
+        return word in self.todict()
+
+    def __len__(self):
+        return len(self.wordlist)
+
+    def __iter__(self):
+        return iter(self.todict())
+
+    def __getattr__(self, name):
+        return getattr(self.todict(), name)
+
+def load_wv_binary(prefix):
+    """load_wv for the files written by convert_wv."""
+    wv = np.load(prefix + ".npy", mmap_mode="r")
+    num_to_word = WordList(prefix)
+    return wv, LazyWordToNum(num_to_word), num_to_word
+
 
 def save_predictions(y, filename):
     """Save predictions, one per line."""
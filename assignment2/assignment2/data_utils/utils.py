@@ -1,9 +1,10 @@
 import sys, os, re, json
 import itertools
-from collections import Counter
+from collections import Counter, OrderedDict
 import time
 from numpy import *
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 import pandas as pd
 
 
@@ -22,9 +23,12 @@ def extract_wv(df):
     wv = df.as_matrix()
     return wv, word_to_num, num_to_word
 
+DIGIT_RE = re.compile(r"\d")
+
 def canonicalize_digits(word):
+    if not DIGIT_RE.search(word): return word # nothing to replace
     if any([c.isalpha() for c in word]): return word
-    word = re.sub("\d", "DG", word)
+    word = DIGIT_RE.sub("DG", word)
     if word.startswith("DG"):
         word = word.replace(",", "") # remove thousands separator
     return word
@@ -37,6 +41,84 @@ def canonicalize_word(word, wordset=None, digits=True):
     if (wordset == None) or (word in wordset): return word
     else: return "UUUNKKK" # unknown token
 
+##
+# Memoized canonicalize_word, with one bounded LRU cache per vocabulary.
+# Vocabularies are told apart by identity, so one must not change while
+# its words are cached.
+
+class LRUCache(object):
+    """Dict holding at most maxsize keys, dropping the least recently used."""
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """The cached value, or None."""
+        value = self.data.pop(key, None)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.data[key] = value # most recent last
+        return value
+
+    def put(self, key, value):
+        self.data[key] = value
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+# one cache per recently used wordset; only these few wordsets are kept alive
+_canonical_caches = LRUCache(4)
+
+def canonical_cache(wordset=None, maxsize=100000):
+    """
+    The LRUCache of canonical words for wordset. Cached results assume
+    wordset is not mutated afterwards: a change of size starts a fresh
+    cache, but replacing words in place gives stale answers.
+    """
+    size = 0 if wordset is None else len(wordset)
+    entry = _canonical_caches.get(id(wordset))
+    if entry is None or entry[0] is not wordset or entry[1] != size:
+        entry = (wordset, size, LRUCache(maxsize))
+        _canonical_caches.put(id(wordset), entry)
+    return entry[2]
+
+def canonicalize_cached(word, wordset=None, digits=True):
+    """canonicalize_word, through the cache of wordset."""
+    cache = canonical_cache(wordset)
+    key = (word, digits)
+    c = cache.get(key)
+    if c is None:
+        c = canonicalize_word(word, wordset, digits)
+        cache.put(key, c)
+    return c
+
+def canonicalize_words(words, wordset=None, digits=True):
+    """
+    canonicalize_word over a whole token list. Each distinct word is
+    looked up once, in the cache of wordset. Returns the canonical
+    words and the number of tokens that did not need canonicalizing.
+    """
+    cache = canonical_cache(wordset)
+    seen = {} # canonical form of each distinct word so far
+    out = []
+    fresh = 0
+    for w in words:
+        c = seen.get(w)
+        if c is None:
+            key = (w, digits)
+            c = cache.get(key)
+            if c is None:
+                c = canonicalize_word(w, wordset, digits)
+                cache.put(key, c)
+                fresh += 1
+            seen[w] = c
+        out.append(c)
+    return out, len(out) - fresh
+
 
 ##
 # Utility functions used to create dataset
@@ -76,6 +158,23 @@ def load_dataset(fname):
         docs.append(cur)
     return docs
 
+def iter_dataset(fname):
+    """
+    Lazy load_dataset: yields one sentence at a time, as a list
+    of [word, tag] pairs, without reading the whole file in.
+    """
+    with open(fname) as fd:
+        cur = []
+        for line in fd:
+            if re.match(r"-DOCSTART-.+", line) or (len(line.strip()) == 0):
+                if len(cur) > 0:
+                    yield cur
+                cur = []
+            else:
+                cur.append(line.strip().split("\t",1))
+        if len(cur) > 0:
+            yield cur
+
 def extract_tag_set(docs):
     tags = set(flatten1([[t[1].split("|")[0] for t in d] for d in docs]))
     return tags
@@ -104,19 +203,26 @@ def seq_to_windows(words, tags, word_to_num, tag_to_num, left=1, right=1):
     return array(X), array(y)
 
 def docs_to_windows(docs, word_to_num, tag_to_num, wsize=3):
+    """
+    Same windows as seq_to_windows over the padded documents, built
+    from one int32 array of the whole token stream: every window is a
+    row of a strided (read-only) view, and rows centered on <s> or
+    </s> are masked out. wsize must be odd.
+    """
+    assert wsize % 2 == 1
     pad = (wsize - 1)/2
     docs = flatten1([pad_sequence(seq, left=pad, right=pad) for seq in docs])
-
-
-    #print "docs = ", docs
     words, tags = zip(*docs)
-    #print len(words)
-    #print words[:5]
-    #print len(tags)
-    #print tags[:5]
-    words = [canonicalize_word(w, word_to_num) for w in words]
-    tags = [t.split("|")[0] for t in tags]
-    return seq_to_windows(words, tags, word_to_num, tag_to_num, pad, pad)
+    words, _ = canonicalize_words(words, word_to_num)
+    ids = np.array([word_to_num[w] for w in words], dtype=np.int32)
+
+    # row r of windows is centered on token r+pad
+    n, s = len(ids), ids.strides[0]
+    windows = as_strided(ids, shape=(n-2*pad, wsize), strides=(s, s))
+    centers = ids[pad:n-pad]
+    keep = (centers != word_to_num["<s>"]) & (centers != word_to_num["</s>"])
+    y = array([tag_to_num[tags[i].split("|")[0]] for i in np.nonzero(keep)[0] + pad])
+    return windows[keep], y
 
 def window_to_vec(window, L):
     """Concatenate word vectors for a given window."""
@@ -157,12 +263,19 @@ def docs_to_indices(docs, word_to_num):
     docs = [pad_sequence(seq, left=1, right=1) for seq in docs]
     ret = []
     for seq in docs:
-        words = [canonicalize_word(wt[0], word_to_num) for wt in seq]
+        words, _ = canonicalize_words([wt[0] for wt in seq], word_to_num)
         ret.append(seq_to_indices(words, word_to_num))
 
     # return as numpy array for fancier slicing
     return np.array(ret, dtype=object)
 
+def iter_indices(docs, word_to_num):
+    """Lazy docs_to_indices, e.g. over the sentences of iter_dataset."""
+    for seq in docs:
+        words, _ = canonicalize_words([wt[0] for wt in pad_sequence(seq, left=1, right=1)],
+                                      word_to_num)
+        yield seq_to_indices(words, word_to_num)
+
 def offset_seq(seq):
     return seq[:-1], seq[1:]
 
@@ -1,8 +1,7 @@
 from numpy import *
 from nn.base import NNBase
-from nn.math import softmax, make_onehot ,random_weight_matrix
+from nn.math import softmax, make_onehot ,random_weight_matrix, sum_rows
 import numpy as np
-import warnings
 
 ##
 # Evaluation code; do not change this
@@ -74,10 +73,22 @@ class WindowMLP(NNBase):
         #### END YOUR CODE ####
 
     def tanh(self,x):
-        return (np.exp(x)-np.exp(-x))*1.0/(np.exp(x)+np.exp(-x))
+        return np.tanh(x) # the exp formula overflows for |x| > ~710
 
     def tanhGrad(self,x):
         return 1-self.tanh(x)**2
+
+    def _forward(self, windows):
+        """
+        Forward pass over a batch of windows, one row per window:
+        returns the inputs x, hidden layer h and class probabilities.
+        A single window is treated as a batch of one.
+        """
+        windows = np.asarray(windows)
+        windows = windows.reshape(-1, windows.shape[-1])
+        x = self.sparams.L[windows].reshape(len(windows), -1)
+        h = self.tanh(x.dot(self.params.W.T)+self.params.b1)
+        return x, h, softmax(h.dot(self.params.U.T)+self.params.b2)
     
     def _acc_grads(self, window, label):
         """
@@ -87,6 +98,10 @@ class WindowMLP(NNBase):
         window = [x_{i-1} x_{i} x_{i+1}] # three ints
         label = {0,1,2,3,4} # single int, gives class
 
+        A whole minibatch can be passed at once, as an (N x windowsize)
+        index matrix and N labels; this accumulates the sum of the
+        per-window gradients with matrix-matrix products.
+
         Your code should update self.grads and self.sgrads,
         in order for gradient_check and training to work.
 
@@ -96,32 +111,38 @@ class WindowMLP(NNBase):
         """
         #### YOUR CODE HERE ####
         
+        windows = np.asarray(window)
+        windows = windows.reshape(-1, windows.shape[-1])
+        labels = np.asarray(label).reshape(-1)
+        N = len(windows)
+
         ##
-        # Forward propagation
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            x = self.sparams.L[window[0]]
-            for i in range(len(window)-1):
-                x = np.concatenate((x,self.sparams.L[window[i+1]]),axis=1)
-        
-        z = self.params.W.dot(x)+self.params.b1
-        h = self.tanh(z)
-        y = make_onehot(label,self.params.b2.shape[0])
-        yP = softmax(self.params.U.dot(h)+self.params.b2)
+        # Forward propagation, one row per window
+        x, h, yP = self._forward(windows)
 
         ##
         # Backpropagation
-        self.grads.U += np.outer(yP-y,h) + self.lreg*self.params.U
-        self.grads.b2 += yP-y
-        self.grads.W += np.outer((self.params.U.T.dot(yP-y)*self.tanhGrad(z)),x) + self.lreg*self.params.W
-        self.grads.b1 += self.params.U.T.dot(yP-y)*self.tanhGrad(z)
-
-        gL = self.params.W.T.dot(self.params.U.T.dot(yP-y)*self.tanhGrad(z))
-        #print len(gL)
-        for i in range(len(window)):
-            self.sgrads.L[window[i]] = gL[len(gL)*i/len(window):len(gL)*(i+1)/len(window)]
+        delta2 = yP # (yP-y)
+        delta2[np.arange(N),labels] -= 1
+        delta1 = delta2.dot(self.params.U)*(1-h**2) # tanhGrad
+        self.grads.U += delta2.T.dot(h) + N*self.lreg*self.params.U
+        self.grads.b2 += np.sum(delta2,axis=0)
+        self.grads.W += delta1.T.dot(x) + N*self.lreg*self.params.W
+        self.grads.b1 += np.sum(delta1,axis=0)
+
+        # one row of L per window slot, summed per word
+        gL = delta1.dot(self.params.W).reshape(windows.size, -1)
+        words, dL = sum_rows(windows.ravel(), gL)
+        for i in range(len(words)):
+            self.sgrads.L[words[i]] = dL[i]
         #### END YOUR CODE ####
 
+    def train_minibatch_sgd(self, X, y, alpha):
+        """Minibatch SGD, the minibatch as a single batched _acc_grads."""
+        self._reset_grad_acc()
+        self._acc_grads(X, y)
+        self._apply_grad_acc(alpha)
+
     def predict_proba(self, windows):
         """
         Predict class probabilities.
@@ -132,19 +153,10 @@ class WindowMLP(NNBase):
         windows = array (n x windowsize),
             each row is a window of indices
         """
-        # handle singleton input by making sure we have
-        # a list-of-lists
-        if not hasattr(windows[0], "__iter__"):
-            windows = [windows]
+        # singleton input is handled by _forward as a batch of one
 
         #### YOUR CODE HERE ####
-        x = self.sparams.L[windows[:,0]]
-        for i in range(len(windows[0])-1):
-            x = np.concatenate((x,self.sparams.L[windows[:,i+1]]),axis=1)
-            
-        z = self.params.W.dot(x.T)+self.params.b1.reshape((self.params.b1.shape[0],1))
-        h = self.tanh(z)
-        p = softmax(self.params.U.dot(h)+self.params.b2.reshape((self.params.b2.shape[0],1)))
+        _, _, p = self._forward(windows)
         #### END YOUR CODE ####
         return p # rows are output for each input
 
@@ -157,7 +169,7 @@ class WindowMLP(NNBase):
 
         #### YOUR CODE HERE ####
         p = self.predict_proba(windows)
-        c = np.argmax(p,axis=0)  #axis=0, column-wise
+        c = np.argmax(p,axis=1)  # one row per window
         #### END YOUR CODE ####
         return c # list of predicted classes
 
@@ -171,21 +183,10 @@ class WindowMLP(NNBase):
 
         #### YOUR CODE HERE ####
 
-        print "windows shape ", windows.shape 
-        x = self.sparams.L[windows[:,0]]
-        for i in range(len(windows[0])-1):
-            x = np.concatenate((x,self.sparams.L[windows[:,i+1]]),axis=1)
-
-        z = self.params.W.dot(x.T)+self.params.b1.reshape((self.params.b1.shape[0],1))
-        h = tanh(z)
-        p = softmax(self.params.U.dot(h)+self.params.b2.reshape((self.params.b2.shape[0],1)))
-        labelArray = np.zeros((len(labels),self.params.b2.shape[0]))
-        for i in range(len(labels)):
-            labelArray[i] = make_onehot(labels[i],self.params.b2.shape[0])
+        _, _, p = self._forward(windows)
+        labels = np.asarray(labels).reshape(-1)
         batch = len(labels)
-        p = p*labelArray.T
-        p = np.sum(p,axis=0)
-        J = np.sum(-np.log(p))
+        J = -np.sum(np.log(p[np.arange(batch),labels]))
         Jreg = batch*(self.lreg/2.0)*(np.sum(self.params.W**2)+np.sum(self.params.U**2))
         J += Jreg                    
         #### END YOUR CODE ####
@@ -295,9 +296,14 @@ def ModelOutputCenterWord(clf,word_to_num,num_to_word,num_to_tag,windowsize):
 ####################################################################
 
 if __name__ == "__main__":
+    import os
     import data_utils.ner as ner
     import data_utils.utils as du
-    wv, word_to_num, num_to_word = ner.load_wv('data/ner/vocab.txt','data/ner/wordVectors.txt')
+    # parse the text vectors once, later runs memory-map the binary copy
+    wvfile = 'data/ner/wordVectors.npy'
+    if not os.path.exists(wvfile):
+        ner.convert_wv('data/ner/vocab.txt','data/ner/wordVectors.txt',wvfile)
+    wv, word_to_num, num_to_word = ner.load_wv('data/ner/vocab.txt',wvfile)
 
 
     tagnames = ["O", "LOC", "MISC", "ORG", "PER"]
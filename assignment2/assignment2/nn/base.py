@@ -491,6 +491,22 @@ class NNBase(object):
         for i in xrange(N):
             yield random.randint(0, high, size=batch)
 
+    @staticmethod
+    def bucketiter(lengths, batch, nepoch=1):
+        """
+        Iterator over minibatches of similar length, for padded
+        batch training: each epoch sorts the shuffled indices by
+        length, cuts them into minibatches and visits those in a
+        random order.
+        """
+        lengths = np.asarray(lengths)
+        for _ in xrange(nepoch):
+            idx = random.permutation(len(lengths))
+            idx = idx[np.argsort(lengths[idx], kind='mergesort')]
+            batches = [idx[i:i+batch] for i in xrange(0, len(idx), batch)]
+            for b in random.permutation(len(batches)):
+                yield batches[b]
+
     @staticmethod
     def annealiter(a0, epoch=10000):
         """
@@ -503,3 +519,118 @@ class NNBase(object):
         while True:
             yield a0 * 1.0/((ctr+epoch)/epoch)
             ctr += 1
+
+
+class BatchedLMMixin(object):
+    """
+    Batched and streaming evaluation for RNN language models.
+
+    _batch_forward and _batch_bptt are the shared parts of padded-batch
+    training, the model adds its own output layer and gradients.
+
+    A model mixing this in provides the per-timestep hooks:
+        _batch_hidden(h, x) : next hidden states, one row per sentence
+        _batch_point_losses(h, y) : -log p(y[j]|h[j]) for every row
+        _batch_reg_loss(Y) : regularization compute_seq_loss adds per sentence
+    """
+
+    def compute_batch_loss(self, X, Y, batchsize=100):
+        """
+        Batched compute_loss over a dataset: returns the total loss and
+        the loss of every sentence, as compute_seq_loss would give them.
+
+        Sentences are sorted by length and run batchsize at a time, so
+        the hidden states advance as one (batch x hdim) matrix and the
+        output layer is one matrix product per timestep. Longest first,
+        the sentences still running at step t are a prefix of the batch.
+        """
+        losses = np.zeros(len(X))
+        order = np.argsort([-len(xs) for xs in X], kind='mergesort')
+        for b in xrange(0, len(X), batchsize):
+            idx = order[b:b+batchsize]
+            lens = np.array([len(X[i]) for i in idx])
+            xs = pad_batch([X[i] for i in idx])
+            ys = pad_batch([Y[i] for i in idx])
+            h = np.zeros((len(idx), self.hdim))
+            for t in xrange(lens[0]):
+                n = np.sum(lens > t)
+                h = self._batch_hidden(h[:n], xs[t,:n])
+                losses[idx[:n]] += self._batch_point_losses(h, ys[t,:n])
+        losses += self._batch_reg_loss(Y)
+        return np.sum(losses), losses
+
+    def compute_stream_loss(self, seqs, carry=False, printevery=10000):
+        """
+        Cross-entropy over an iterable of index sequences, such as
+        du.iter_indices(du.iter_dataset(fname), word_to_num), holding
+        one sentence in memory at a time. With carry, the hidden state
+        runs on across sentence boundaries instead of restarting from
+        zeros. Prints the running perplexity every printevery sentences.
+
+        Returns the total loss (without regularization) and the number
+        of tokens, so the perplexity is exp(J/ntot).
+        """
+        J, ntot = 0.0, 0
+        h = np.zeros((1, self.hdim))
+        for count, seq in enumerate(seqs):
+            xs, ys = seq[:-1], seq[1:]
+            if not carry:
+                h = np.zeros((1, self.hdim))
+            hs = np.zeros((len(xs), self.hdim))
+            for t in xrange(len(xs)):
+                h = self._batch_hidden(h, xs[t:t+1])
+                hs[t] = h
+            J += np.sum(self._batch_point_losses(hs, ys))
+            ntot += len(ys)
+            if printevery > 0 and (count+1) % printevery == 0:
+                print "  %d sentences, %d tokens: perplexity %.2f" % (count+1, ntot, np.exp(J/ntot))
+        return J, ntot
+
+    def _batch_forward(self, X, Y):
+        """
+        Forward pass of padded-batch training over the sentences X with
+        targets Y. Sorted longest first, the sentences still running at
+        step t are the first counts[t] columns, so padding is never
+        computed. Returns the padded (ns x batch) xs and ys, counts,
+        the mask of real (t, j) steps and the hidden states hs, an
+        (ns+1 x batch x hdim) array with hs[0] = 0.
+        """
+        order = np.argsort([-len(xs) for xs in X], kind='mergesort')
+        lens = np.array([len(X[i]) for i in order])
+        xs = pad_batch([X[i] for i in order])
+        ys = pad_batch([Y[i] for i in order])
+        ns, nb = xs.shape
+        counts = np.sum(lens > np.arange(ns).reshape(-1,1), axis=1)
+        mask = np.arange(ns).reshape(-1,1) < lens # (t, j) inside sentence j
+        hs = np.zeros((ns+1, nb, self.hdim))
+        for t in range(ns):
+            n = counts[t]
+            hs[t+1,:n] = self._batch_hidden(hs[t,:n], xs[t,:n])
+        return xs, ys, counts, mask, hs
+
+    def _batch_bptt(self, grad0, hs, counts):
+        """
+        Truncated BPTT through sigmoid hidden layers for a batch from
+        _batch_forward: grad0[t] is dJ/dh(t+1) from the output layer.
+        Returns deltas, where deltas[t] sums every error reaching z(t+1)
+        within self.bptt steps, zero on padding.
+        """
+        ns, nb, _ = grad0.shape
+        sgz = hs*(1-hs) # sigmoidGrad, from the activations
+        deltas = np.zeros(grad0.shape)
+        for i in range(ns):
+            n = counts[i]
+            vectorCurrent = grad0[i,:n]*sgz[i+1,:n]
+            for j in range(min(i+1,self.bptt+1)):
+                deltas[i-j,:n] += vectorCurrent
+                vectorCurrent = vectorCurrent.dot(self.params.H)*sgz[i-j,:n]
+        return deltas
+
+    def _batch_hidden(self, h, x):
+        raise NotImplementedError("_batch_hidden not yet implemented")
+
+    def _batch_point_losses(self, h, y):
+        raise NotImplementedError("_batch_point_losses not yet implemented")
+
+    def _batch_reg_loss(self, Y):
+        raise NotImplementedError("_batch_reg_loss not yet implemented")
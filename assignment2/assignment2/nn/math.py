@@ -1,5 +1,6 @@
 from numpy import *
 import numpy as np
+import heapq
 
 def sigmoid(x):
     return 1.0/(1.0 + exp(-x))
@@ -9,14 +10,32 @@ def sigmoidGrad(x):
 
 
 def softmax(x):
-    #x = x-x.max(axis=1).reshape(x.shape[0],1)
-    #b = np.sum(np.exp(x),axis=1)
-    #x = np.exp(x)/b.reshape(x.shape[0],1)
+    """
+    Softmax of a vector, or of every row of a matrix: 2-D input is
+    (N x classes), one distribution per row, as in the rnnlm output
+    layer and nerwindow.WindowMLP._forward.
+    """
+    if x.ndim == 2: # one distribution per row
+        x = x-x.max(axis=1).reshape(x.shape[0],1)
+        b = np.sum(np.exp(x),axis=1)
+        x = np.exp(x)/b.reshape(x.shape[0],1)
+        return x
     x = x-x.max()
     b = np.sum(np.exp(x))
     x = np.exp(x)/b
     return x
 
+def pad_batch(seqs, pad=0):
+    """
+    Stacks index sequences into a (maxlen x len(seqs)) matrix, one
+    column per sequence, filling past the end of each with pad.
+    """
+    out = np.empty((max(len(s) for s in seqs), len(seqs)), dtype=int)
+    out.fill(pad)
+    for j, s in enumerate(seqs):
+        out[:len(s), j] = s
+    return out
+
 def make_onehot(i, n):
     y = np.zeros(n)
     y[i] = 1
@@ -28,6 +47,16 @@ def random_weight_matrix(m,n):
     assert (A0.shape == (m,n))
     return A0
 
+def sum_rows(idx, vals):
+    """
+    Sums the rows of vals that share an index in idx.
+    Returns the unique indices and one summed row for each.
+    """
+    idx, inv = np.unique(idx, return_inverse=True)
+    out = np.zeros((len(idx),) + vals.shape[1:])
+    np.add.at(out, inv, vals)
+    return idx, out
+
 class MultinomialSampler(object):
     """
     Fast (O(log n)) sampling from a discrete probability
@@ -67,96 +96,284 @@ def multinomial_sample(p):
     return MultinomialSampler(p).sample(1)[0]
 
 
-class Node:
-    def __init__(self, label, word=None):
-        self.label = label
-        self.parent = None
-        self.left = None
-        self.right = None
-        self.isLeaf = False
-        self.isLeft = False
-        self.hActs = None
-        self.grad = None
-    
+class AliasSampler(object):
+    """
+    Walker's alias method, with Vose's O(n) set-up: then O(1) per
+    sample. Column i of the table keeps i with probability prob[i]
+    and gives alias[i] otherwise, so a sample is one uniform column
+    and one biased coin.
+    """
+
+    def __init__(self, p):
+        n = len(p)
+        q = np.asarray(p, dtype=float) * (n / float(np.sum(p)))
+        self.prob = np.ones(n) # columns left over at the end are full
+        self.alias = np.arange(n)
+        small = list(np.nonzero(q < 1)[0])
+        large = list(np.nonzero(q >= 1)[0])
+        while len(small) > 0 and len(large) > 0:
+            s, l = small.pop(), large.pop()
+            self.prob[s], self.alias[s] = q[s], l
+            q[l] -= 1 - q[s]
+            if q[l] < 1:
+                small.append(l)
+            else:
+                large.append(l)
+
+    def sample(self, k=1):
+        cols = np.random.randint(0, len(self.prob), size=k)
+        keep = np.random.random(k) < self.prob[cols]
+        return np.where(keep, cols, self.alias[cols])
+
+    def __call__(self, **kwargs):
+        return self.sample(**kwargs)
+
+    def reconstruct_p(self):
+        """Return the original probability vector."""
+        n = len(self.prob)
+        p = self.prob / n
+        np.add.at(p, self.alias, (1 - self.prob) / n)
+        return p
+
+
+_alias_cache = {}
+
+def alias_sampler(p, key=None):
+    """
+    AliasSampler for p, built once per distribution: later calls with
+    the same key object (p itself by default) reuse the table, so p
+    must not change in place. Keeps at most 16 tables.
+    """
+    if key is None:
+        key = p
+    entry = _alias_cache.get(id(key))
+    if entry is None or entry[0] is not key:
+        if len(_alias_cache) >= 16:
+            _alias_cache.clear()
+        entry = (key, AliasSampler(p))
+        _alias_cache[id(key)] = entry
+    return entry[1]
+
+
 class HierarchicalSoftmaxTree:
-    
-    def __init__(self, vocabsize,hDim,word2node):
-        self.cnt = 0
-        self.hDim = hDim
+    """
+    Binary tree over the vocabulary for a hierarchical softmax, kept flat:
+    U has one parameter row per internal node, and the root-to-leaf path
+    of every word is stored as internal node indices and codes (1 for a
+    left turn, 0 for a right one), concatenated over all words with
+    offsets[w]:offsets[w+1] selecting word w. Then
+
+        p(w|h) = prod over the path of sigmoid((2*code-1) * U[node].dot(h))
+
+    Gradients are accumulated sparsely, for the internal nodes touched
+    since the last reset().
+
+    By default the tree is balanced over the word indices. Given word
+    counts it is built as a Huffman code instead, so frequent words get
+    short paths.
+    """
+
+    def __init__(self, vocabsize, hDim, counts=None):
         self.vocabsize = vocabsize
-        self.root = self.parse(0,vocabsize,word2node)
-
-    def parse(self,l,r,word2node,parent=None,isLeft=False):
-        node = Node(self.cnt)
-        self.cnt += 1
-        node.isLeft = isLeft
-        node.parent = parent
-        if l == r:
-            node.isLeaf = True
-            word2node[l] = node
-            return node
-            
-        node.hActs = np.random.random(self.hDim)
-        mid = (l+r)/2
-        node.left = self.parse(l,mid,word2node,parent=node,isLeft=True)
-        node.right = self.parse(mid+1,r,word2node,parent=node)
-        return node
-        
-    def getSumSquareU(self, node):
-        if node.isLeaf == True:
-            return 0
-        if node.grad == None:
-            return 0
-
-        sum1 = np.sum(node.hActs**2)
-        sum1 = sum1 + self.getSumSquareU(node.right)
-        sum1 = sum1 + self.getSumSquareU(node.left)
-        return sum1
-
-    def regularizedGrad(self,node, lreg):    
-        if node.isLeaf == True:
-            return
-        if node.grad == None:
-            return 
-
-        node.grad = node.grad + lreg*node.hActs
-        self.regularizedGrad(node.left,lreg)
-        self.regularizedGrad(node.right,lreg)
-
-    def reset(self,node):
-        if node.isLeaf == True:
-            return
-        if node.grad == None:
-            return
- 
-        node.grad = None
-        self.reset(node.left)
-        self.reset(node.right)
-
-    def apply_grad_acc(self,node,alpha):
-        if node.isLeaf == True:
-            return 
-        if node.grad == None:
-            return         
-
-        node.hActs = node.hActs + alpha*node.grad
-        self.apply_grad_acc(node.left,alpha)
-        self.apply_grad_acc(node.right,alpha)
-        
+        self.hDim = hDim
+        if counts is None:
+            self.set_paths(*self.balanced_paths(vocabsize))
+        else:
+            assert len(counts) == vocabsize
+            self.set_paths(*self.huffman_paths(counts))
+        self.U = np.random.random((self.numInternal, hDim))
+        self.reset()
+
+    @staticmethod
+    def balanced_paths(vocabsize):
+        """
+        Paths of the tree that splits words [l,r] at (l+r)/2,
+        with internal nodes numbered in pre-order.
+        """
+        paths = [None]*vocabsize
+        stack = [(0, vocabsize-1, [], [])]
+        count = 0
+        while len(stack) > 0:
+            l, r, nodes, codes = stack.pop()
+            if l == r:
+                paths[l] = (nodes, codes)
+                continue
+            mid = (l+r)/2
+            stack.append((mid+1, r, nodes+[count], codes+[0]))
+            stack.append((l, mid, nodes+[count], codes+[1]))
+            count += 1
+        return paths, count
+
+    @staticmethod
+    def huffman_paths(counts):
+        """
+        Paths of the Huffman tree of counts: the two least frequent
+        subtrees are merged until one is left. Internal node k is the
+        k-th merge, so the root is the last one.
+        """
+        V = len(counts)
+        heap = [(c, w) for w, c in enumerate(counts)] # ids < V are words
+        heapq.heapify(heap)
+        children = [] # children[k] of internal node k, id V+k in the heap
+        while len(heap) > 1:
+            c1, a = heapq.heappop(heap)
+            c2, b = heapq.heappop(heap)
+            heapq.heappush(heap, (c1+c2, V+len(children)))
+            children.append((a, b))
+
+        # walk down from the root, children always come from earlier merges
+        paths = [None]*V
+        prefix = {V+len(children)-1: ([], [])}
+        for k in reversed(range(len(children))):
+            nodes, codes = prefix.pop(V+k)
+            for child, code in zip(children[k], (1, 0)):
+                path = (nodes+[k], codes+[code])
+                if child < V:
+                    paths[child] = path
+                else:
+                    prefix[child] = path
+        return paths, len(children)
+
+    def set_paths(self, paths, numInternal):
+        """Flattens a list of (nodes, codes) paths, one per word."""
+        lens = np.array([len(nodes) for nodes, _ in paths])
+        self.numInternal = numInternal
+        self.offsets = np.concatenate([[0], np.cumsum(lens)])
+        self.nodes = np.array([n for nodes, _ in paths for n in nodes], dtype=int)
+        self.codes = np.array([c for _, codes in paths for c in codes], dtype=float)
+        self.words = np.repeat(np.arange(len(paths)), lens)
+
+        # child[n, code] is the internal node reached from n, or ~w for word w
+        last = self.offsets[1:] - 1
+        nxt = np.empty(len(self.nodes), dtype=int)
+        nxt[:-1] = self.nodes[1:]
+        nxt[last] = ~np.arange(len(paths))
+        self.child = np.zeros((numInternal, 2), dtype=int)
+        self.child[self.nodes, self.codes.astype(int)] = nxt
+        self.root = self.nodes[0]
+
+        # levels[d] holds the internal nodes at depth d
+        depth = np.zeros(numInternal, dtype=int)
+        depth[self.nodes] = np.arange(len(self.nodes)) - np.repeat(self.offsets[:-1], lens)
+        order = np.argsort(depth, kind='mergesort')
+        self.levels = np.split(order, np.cumsum(np.bincount(depth))[:-1])
+
+    def path_pairs(self, ys):
+        """
+        The paths of all targets in ys, flattened: returns, for every
+        step on every path, the index into ys, the node and the code.
+        """
+        ys = np.asarray(ys)
+        lens = self.offsets[ys+1] - self.offsets[ys]
+        rows = np.repeat(np.arange(len(ys)), lens)
+        pos = np.arange(rows.size) + np.repeat(self.offsets[ys] - (np.cumsum(lens)-lens), lens)
+        return rows, self.nodes[pos], self.codes[pos]
+
+    def _scores(self, hs, ys):
+        rows, nodes, codes = self.path_pairs(ys)
+        z = np.sum(self.U[nodes]*hs[rows], axis=1)
+        return rows, nodes, codes, z
+
+    def seq_loss(self, hs, ys):
+        """Sum of -log p(ys[t]|hs[t]), hs has one row per target."""
+        _, _, codes, z = self._scores(hs, ys)
+        return np.sum(np.logaddexp(0, -(2*codes-1)*z))
+
+    def point_losses(self, hs, ys):
+        """-log p(ys[t]|hs[t]) for every t."""
+        rows, _, codes, z = self._scores(hs, ys)
+        return np.bincount(rows, weights=np.logaddexp(0, -(2*codes-1)*z), minlength=len(ys))
+
+    def sum_square(self, ys):
+        """Squared norm of the rows of U on the paths of ys."""
+        _, nodes, _ = self.path_pairs(ys)
+        return np.sum(self.U[np.unique(nodes)]**2)
+
+    def acc_grads(self, hs, ys, lreg=0.0, seqs=None):
+        """
+        Accumulates dJ/dU for seq_loss(hs, ys) + 0.5*lreg*sum_square(ys)
+        and returns dJ/dh, one row per row of hs.
+
+        seqs, if given, labels the sentence of every row of a batch: a
+        node is then regularized once per sentence reaching it, as if
+        acc_grads had run on each sentence in turn.
+        """
+        rows, nodes, codes, z = self._scores(hs, ys)
+        g = (sigmoid(z) - codes).reshape(-1,1)
+        dh = np.zeros(hs.shape)
+        np.add.at(dh, rows, g*self.U[nodes])
+        if seqs is None:
+            touched = np.unique(nodes)
+        else:
+            n = self.U.shape[0]
+            touched = np.unique(np.asarray(seqs)[rows]*n + nodes) % n
+        self._gradNodes += [nodes, touched]
+        self._gradVals += [g*hs[rows], lreg*self.U[touched]]
+        return dh
+
+    def grads(self):
+        """Accumulated gradient as (touched nodes, rows of dJ/dU)."""
+        if len(self._gradNodes) == 0:
+            return np.zeros(0, dtype=int), np.zeros((0, self.hDim))
+        return sum_rows(np.concatenate(self._gradNodes), np.vstack(self._gradVals))
+
+    def reset(self):
+        self._gradNodes = []
+        self._gradVals = []
+
+    def apply_grad_acc(self, alpha):
+        nodes, dU = self.grads()
+        self.U[nodes] += alpha*dU
+
     #####  For generating sequence ######
-    def getDistributionRecursive(self,l,r,pArray,h,tmpProbability,node):
-        if l == r:
-            pArray.append(tmpProbability)
-            return
-        mid = (l+r)/2
-        self.getDistributionRecursive(l,mid,pArray,h, tmpProbability*sigmoid(node.hActs*h),node.left)
-        self.getDistributionRecursive(mid+1,r,pArray,h,tmpProbability*sigmoid(-node.hActs*h),node.right)
-            
-    def getDistribution(self,h):
-        pArray = []
-        self.getDistributionRecursive(0,self.vocabsize,pArray,h,1.0,self.root)
-        return pArray
-
-        
+    def logDistribution(self, h):
+        """
+        log p(w|h) for every word in the vocabulary, computed level by
+        level from the root down, one vector operation per depth.
+        """
+        z = self.U.dot(h)
+        logq = np.zeros(self.numInternal) # log p of reaching each node
+        logp = np.zeros(self.vocabsize)
+        for level in self.levels:
+            for code in (1, 0):
+                child = self.child[level, code]
+                lp = logq[level] - np.logaddexp(0, -(2*code-1)*z[level])
+                inner = child >= 0
+                logq[child[inner]] = lp[inner]
+                logp[~child[~inner]] = lp[~inner]
+        return logp
+
+    def getDistribution(self, h):
+        """p(w|h) for every word in the vocabulary."""
+        return np.exp(self.logDistribution(h))
 
+    def sample(self, h):
+        """
+        Draws a word from p(.|h) by walking down from the root, one
+        dot product per node on the path. Returns (word, log p(word|h)).
+        """
+        node, logp = self.root, 0.0
+        while node >= 0:
+            q = sigmoid(self.U[node].dot(h)) # p of turning left
+            code = int(np.random.random() < q)
+            logp += np.log(q if code else 1.0-q)
+            node = self.child[node, code]
+        return ~node, logp
 
+    def topk(self, h, k):
+        """
+        The k most likely words under p(.|h), best first, as a list of
+        (word, log p(word|h)). Searches the tree best-first, which only
+        expands nodes more likely than the k-th word.
+        """
+        heap = [(0.0, self.root)]
+        top = []
+        while len(heap) > 0 and len(top) < k:
+            neglogp, node = heapq.heappop(heap)
+            if node < 0:
+                top.append((~node, -neglogp))
+                continue
+            z = self.U[node].dot(h)
+            heapq.heappush(heap, (neglogp + np.logaddexp(0, -z), self.child[node, 1]))
+            heapq.heappush(heap, (neglogp + np.logaddexp(0, z), self.child[node, 0]))
+        return top
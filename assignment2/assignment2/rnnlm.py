@@ -6,13 +6,13 @@ import sys
 import cPickle as pickle
 
 # Import NN utils
-from nn.base import NNBase
-from nn.math import softmax, sigmoid, sigmoidGrad,make_onehot
-from nn.math import MultinomialSampler, multinomial_sample
+from nn.base import NNBase, BatchedLMMixin, SparseDelta
+from nn.math import softmax, sigmoid, sigmoidGrad,make_onehot, sum_rows
+from nn.math import MultinomialSampler, multinomial_sample, AliasSampler, alias_sampler
 from misc import random_weight_matrix
 
 
-class RNNLM(NNBase):
+class RNNLM(BatchedLMMixin, NNBase):
     """
     Implements an RNN language model of the form:
     h(t) = sigmoid(H * h(t-1) + L[x(t)])                    #  h(t) = sigmoid(H*h(t-1) + W*L[x(t)])
@@ -115,8 +115,6 @@ class RNNLM(NNBase):
         # make matrix here of corresponding h(t)
         # hs[-1] = initial hidden state (zeros)
         hs = np.zeros((ns+1, self.hdim))
-        # predicted probas
-        ps = np.zeros((ns+1, self.vdim))
 
         #### YOUR CODE HERE ####
         ##
@@ -126,34 +124,89 @@ class RNNLM(NNBase):
         for i in range(ns):
             zs[i+1] = self.params.H.dot(hs[i]) + self.params.W.dot(self.sparams.L[xs[i]])
             hs[i+1] = sigmoid(zs[i+1])
-            ps[i+1] = softmax(self.params.U.dot(hs[i+1]))
         ##
         # Backward propagation through time
-        sgradsTmp = np.zeros((self.vdim,self.hdim)) 
-        grad0 = np.zeros((ns+1,self.hdim)) # (y-t)*U 
+        grad0 = self._acc_output_grads(hs[1:], ys)
+        sgz = sigmoidGrad(zs)
+
+        # deltas[t] sums every error that reaches z(t+1) within its bptt
+        # window, all of which share the inputs h(t) and L[x(t)]
+        deltas = np.zeros((ns,self.hdim))
         for i in range(ns):
-            grad0[i+1] = (ps[i+1]-make_onehot(ys[i],self.vdim)).dot(self.params.U)
-            self.grads.U += np.outer((ps[i+1]-make_onehot(ys[i],self.vdim)),hs[i+1])
-            vectorCurrent = grad0[i+1]*sigmoidGrad(zs[i+1])
+            vectorCurrent = grad0[i]*sgz[i+1]
             for j in range(min(i+1,self.bptt+1)):
-                xh1 = np.ones((self.hdim, self.hdim)).dot(np.diag(hs[i-j]))
-                self.grads.H += np.diag(vectorCurrent).dot(xh1)
-                x1 = np.ones((self.hdim, self.hdim)).dot(np.diag(self.sparams.L[xs[i-j]]))
-                self.grads.W += np.diag(vectorCurrent).dot(x1)
-                sgradsTmp[xs[i-j]] += vectorCurrent.dot(self.params.W)
-                
+                deltas[i-j] += vectorCurrent
                 vectorCurrent = vectorCurrent.dot(self.params.H)
-                vectorCurrent = vectorCurrent*sigmoidGrad(zs[i-j])
+                vectorCurrent = vectorCurrent*sgz[i-j]
 
-        self.grads.U += self.lreg*self.params.U
-        self.grads.H += self.lreg*self.params.H
-        self.grads.W += self.lreg*self.params.W
-        
-        for i in range(len(sgradsTmp)):
-            self.sgrads.L[i] = sgradsTmp[i,:]
+        # one rank-ns update per matrix, instead of an outer product per step
+        self.grads.H += deltas.T.dot(hs[:-1])
+        self.grads.W += deltas.T.dot(self.sparams.L[xs])
+
+        self._acc_reg_grads(1)
+
+        # emit only the rows of L this sentence touched
+        words, dL = sum_rows(xs, deltas.dot(self.params.W))
+        for i in range(len(words)):
+            self.sgrads.L[words[i]] = dL[i]
         #### END YOUR CODE ####
 
 
+    def _acc_output_grads(self, hs, ys):
+        """
+        Output layer of _acc_grads, a full softmax over the vocabulary.
+        hs has one row h(t) per target in ys. Accumulates dJ/dU and
+        returns dJ/dh(t), one row per timestep.
+        """
+        ns = len(ys)
+        # predicted probas minus the one-hot targets, (y-t)
+        dys = softmax(hs.dot(self.params.U.T))
+        dys[np.arange(ns),ys] -= 1
+        self.grads.U += dys.T.dot(hs)
+        return dys.dot(self.params.U)
+
+    def _acc_reg_grads(self, n):
+        """Accumulates the gradient of n sentences' L2 terms."""
+        self.grads.U += n*self.lreg*self.params.U
+        self.grads.H += n*self.lreg*self.params.H
+        self.grads.W += n*self.lreg*self.params.W
+
+    def _acc_batch_grads(self, X, Y):
+        """
+        Accumulates the same gradients as _acc_grads on every sentence
+        of X, Y in turn, running them as one batch: the hidden states
+        are (batch x hdim) matrices, padded past the end of each
+        sentence; see BatchedLMMixin._batch_forward.
+        """
+        xs, ys, counts, mask, hs = self._batch_forward(X, Y)
+        ns, nb = xs.shape
+
+        ##
+        # Output layer on all real timesteps at once, then BPTT
+        grad0 = np.zeros((ns, nb, self.hdim))
+        grad0[mask] = self._acc_output_grads(hs[1:][mask], ys[mask])
+        deltas = self._batch_bptt(grad0, hs, counts)[mask]
+        self.grads.H += deltas.T.dot(hs[:-1][mask])
+        self.grads.W += deltas.T.dot(self.sparams.L[xs[mask]])
+
+        # regularization, once per sentence as in _acc_grads
+        self._acc_reg_grads(len(X))
+
+        words, dL = sum_rows(xs[mask], deltas.dot(self.params.W))
+        for i in range(len(words)):
+            self.sgrads.L[words[i]] = dL[i]
+
+    def train_minibatch_sgd(self, X, y, alpha):
+        """
+        Minibatch SGD on the summed gradient of the sentences, computed
+        as one padded batch. Minibatches of similar length waste the
+        least work, see NNBase.bucketiter.
+        """
+        self._reset_grad_acc()
+        self._acc_batch_grads(X, y)
+        self._apply_grad_acc(alpha)
+
+
     def grad_check(self, x, y, outfd=sys.stderr, **kwargs):
         """
         Wrapper for gradient check on RNNs;
@@ -221,6 +274,22 @@ class RNNLM(NNBase):
         return J / float(ntot)
 
 
+    def _batch_hidden(self, h, x):
+        """One timestep for a batch: rows of h are the previous states."""
+        return sigmoid(h.dot(self.params.H.T) + self.sparams.L[x].dot(self.params.W.T))
+
+    def _batch_point_losses(self, h, y):
+        """-log p(y[j]|h[j]) for every row, as one product with U."""
+        z = h.dot(self.params.U.T)
+        zmax = z.max(axis=1)
+        logZ = zmax + np.log(np.sum(np.exp(z - zmax.reshape(-1,1)), axis=1))
+        return logZ - z[np.arange(len(y)), y]
+
+    def _batch_reg_loss(self, Y):
+        """The regularization term compute_seq_loss adds per sentence."""
+        return 0.5*self.lreg*(np.sum(self.params.H**2)+np.sum(self.params.W**2)+np.sum(self.params.U**2))
+
+
     def generate_sequence(self, init, end, maxlen=100):
         """
         Generate a sequence from the language model,
@@ -245,26 +314,241 @@ class RNNLM(NNBase):
             ys = sequence of indices
             J = total cross-entropy loss of generated sequence
         """
-        J = 0 # total loss
-        ys = [init] # emitted sequence
+        #### YOUR CODE HERE ####
+        seqs, J = RNNLMDecoder(self).sample(init, end, n=1, maxlen=maxlen)
+        ys = seqs[0]
+        Jreg = 0.5*self.lreg*(np.sum(self.params.H**2)+np.sum(self.params.W**2)+np.sum(self.params.U**2))
+        #### YOUR CODE HERE ####
+        return ys, J[0]+Jreg
+
+
+
+class SampledSoftmaxRNNLM(RNNLM):
+    """
+    RNNLM trained with sampled softmax: each sentence scores its targets
+    against k words drawn from a unigram noise distribution instead of
+    the whole vocabulary, so training costs O(k) rather than O(|V|) per
+    timestep. compute_seq_loss, and so perplexity, still uses the full
+    softmax. A minibatch trained as one batch shares its noise words.
+
+    U is updated sparsely: its gradient is kept as (rows, values) pairs
+    in self.Ugrads, and the L2 term only covers the rows a call to
+    _acc_output_grads touched (targets and noise words), once per call,
+    so per sentence or per minibatch. Nothing in training is dense in |V|.
+
+    Arguments (in addition to RNNLM's):
+        noise : unigram counts or frequencies of the vocabulary words,
+                e.g. vocab.freq from data/lm/vocab.ptb.txt (default uniform)
+        k : number of noise words sampled per sentence
+    """
+
+    def __init__(self, L0, U0=None, noise=None, k=100, **kwargs):
+        RNNLM.__init__(self, L0, U0, **kwargs)
+        if noise is None:
+            noise = np.ones(self.vdim)
+        noise = np.asarray(noise, dtype=float)
+        assert noise.shape == (self.vdim,)
+        self.k = k
+        self.sampler = AliasSampler(noise)
+        # log(k*Q(w)), expected count of w among the k samples
+        self.logkq = np.log(k*self.sampler.reconstruct_p())
+        self.samples = None # fixed noise words, set while grad checking
+        self.Ugrads = SparseDelta()
+
+    def _sampled_probs(self, hs, ys, S):
+        """
+        Softmax over [target, noise words S] for each row of hs, with the
+        logits corrected by log(k*Q(w)). Noise words equal to the row's
+        target (accidental hits) are left out.
+        """
+        logits = np.zeros((len(ys), len(S)+1))
+        logits[:,0] = np.sum(hs*self.params.U[ys], axis=1) - self.logkq[ys]
+        logits[:,1:] = hs.dot(self.params.U[S].T) - self.logkq[S]
+        logits[:,1:][S == np.reshape(ys, (-1,1))] = -inf
+        logits -= logits.max(axis=1).reshape(-1,1)
+        ps = np.exp(logits)
+        return ps / ps.sum(axis=1).reshape(-1,1)
+
+    def _draw_samples(self):
+        if self.samples is not None:
+            return self.samples
+        return self.sampler.sample(self.k)
+
+    def _acc_output_grads(self, hs, ys):
+        """
+        Sampled softmax output layer: only the rows of U for the targets
+        and the noise words get a gradient, regularization included.
+        """
+        S = self._draw_samples()
+        dys = self._sampled_probs(hs, ys, S)
+        dys[:,0] -= 1
+        rows, dU = sum_rows(np.concatenate([ys, S]),
+                            np.vstack([dys[:,:1]*hs, dys[:,1:].T.dot(hs)]))
+        self.Ugrads[rows] = dU + self.lreg*self.params.U[rows]
+        return dys[:,:1]*self.params.U[ys] + dys[:,1:].dot(self.params.U[S])
+
+    def _acc_reg_grads(self, n):
+        # U's rows are regularized in _acc_output_grads
+        self.grads.H += n*self.lreg*self.params.H
+        self.grads.W += n*self.lreg*self.params.W
+
+    def _reset_grad_acc(self):
+        """Reset accumulated gradients, leaving the unused grads.U alone."""
+        self.grads.H.fill(0)
+        self.grads.W.fill(0)
+        self.Ugrads.reset()
+        self.sgrads.reset()
+
+    def _apply_grad_acc(self, alpha=1.0):
+        """
+        Update parameters with accumulated gradients: H and W densely,
+        U only on the rows in self.Ugrads. alpha is a scalar.
+        """
+        self.params.H -= alpha*self.grads.H
+        self.params.W -= alpha*self.grads.W
+        for rows, dU in self.Ugrads:
+            self.params.U[rows] -= alpha*dU
+        self.sgrads.apply_to(self.sparams, alpha=-1*alpha)
 
-        ns = maxlen
+    def compute_sampled_loss(self, xs, ys):
+        """
+        The sampled softmax loss _acc_grads follows, for the
+        noise words in self.samples.
+        """
+        ns = len(xs)
         hs = np.zeros((ns+1,self.hdim))
-        #### YOUR CODE HERE ####
         for i in range(ns):
-            hs[i+1] = sigmoid(self.params.H.dot(hs[i])+self.params.W.dot(self.sparams.L[ys[i]]))
-            p = softmax(self.params.U.dot(hs[i+1]))
-            y = multinomial_sample(p)
-            ys.append(y)
-            if y == end:
+            hs[i+1] = sigmoid(self.params.H.dot(hs[i])+self.params.W.dot(self.sparams.L[xs[i]]))
+        ps = self._sampled_probs(hs[1:], ys, self.samples)
+        J = -np.sum(np.log(ps[:,0]))
+        rows = np.unique(np.concatenate([ys, self.samples]))
+        Jreg = 0.5*self.lreg*(np.sum(self.params.H**2)+np.sum(self.params.W**2)+np.sum(self.params.U[rows]**2))
+        return J + Jreg
+
+    def _acc_dense_grads(self, xs, ys):
+        """_acc_grads, with self.Ugrads copied into grads.U for grad_check."""
+        RNNLM._acc_grads(self, xs, ys)
+        self.grads.U.fill(0)
+        for rows, dU in self.Ugrads:
+            self.grads.U[rows] += dU
+
+    def grad_check(self, x, y, outfd=sys.stderr, **kwargs):
+        """
+        Checks the gradient against the sampled loss, holding one
+        draw of noise words fixed.
+        """
+        self.samples = self.sampler.sample(self.k)
+        self.compute_seq_loss = self.compute_sampled_loss
+        self._acc_grads = self._acc_dense_grads
+        try:
+            RNNLM.grad_check(self, x, y, outfd=outfd, **kwargs)
+        finally:
+            del self.compute_seq_loss, self._acc_grads
+            self.samples = None
+
+
+class RNNLMDecoder(object):
+    """
+    Incremental generation from a trained RNNLM. A decoding state is an
+    (n x hdim) matrix with one hidden state per sequence, so every step
+    advances n sequences with one matrix product per layer. The output
+    log-probabilities are written to one scratch buffer, reused (and
+    overwritten) from step to step.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.buf = np.empty((0, model.vdim))
+
+    def initial_state(self, n=1):
+        return np.zeros((n, self.model.hdim))
+
+    def step(self, state, tokens):
+        """
+        Feeds one token per row of state. Returns the new state and the
+        (n x V) log-probabilities of the next word, a view of the
+        scratch buffer valid until the next call.
+        """
+        h = self.model._batch_hidden(state, np.asarray(tokens))
+        if self.buf.shape[0] < len(h):
+            self.buf = np.empty((len(h), self.model.vdim))
+        logp = self.buf[:len(h)]
+        np.dot(h, self.model.params.U.T, out=logp)
+        logp -= logp.max(axis=1).reshape(-1,1)
+        logp -= np.log(np.sum(np.exp(logp), axis=1)).reshape(-1,1)
+        return h, logp
+
+    def sample(self, init, end, n=1, maxlen=100):
+        """
+        Samples n sequences in parallel, each from init until it emits
+        end or maxlen words. Returns the sequences (starting with init)
+        and their total cross-entropy -log p, including the end word.
+        """
+        seqs = [[init] for _ in xrange(n)]
+        J = np.zeros(n)
+        live = np.arange(n) # sequences still running
+        state = self.initial_state(n)
+        tokens = np.empty(n, dtype=int)
+        tokens.fill(init)
+        cdfbuf = np.empty((n, self.model.vdim))
+        for t in xrange(maxlen):
+            state, logp = self.step(state, tokens)
+            # inverse CDF sampling of one word per row
+            cdf = np.exp(logp, out=cdfbuf[:len(live)])
+            np.cumsum(cdf, axis=1, out=cdf)
+            r = np.random.random(len(live))*cdf[:,-1]
+            ys = np.minimum(np.sum(cdf < r.reshape(-1,1), axis=1), self.model.vdim-1)
+            J[live] -= logp[np.arange(len(live)),ys]
+            for i, y in zip(live, ys):
+                seqs[i].append(y)
+            running = ys != end
+            live, state, tokens = live[running], state[running], ys[running]
+            if len(live) == 0:
                 break
-            p = p*make_onehot(y,self.vdim)
-            J += -np.log(np.sum(p))
-            
-        Jreg = 0.5*self.lreg*(np.sum(self.params.H**2)+np.sum(self.params.W**2)+np.sum(self.params.U**2))
-        #### YOUR CODE HERE ####
-        return ys, J+Jreg
+        return seqs, J
 
+    def beam_search(self, init, end, width=5, maxlen=100):
+        """
+        The width most likely sequences from init, by beam search over
+        at most maxlen words. Returns (sequence, -log p) pairs, best
+        first; sequences still running at maxlen are included.
+
+        Each step keeps width live beams, however many candidates end,
+        and the search stops once the best live beam is already worse
+        than the width-th finished one (costs only grow).
+        """
+        V = self.model.vdim
+        beams = [[init]]
+        scores = np.zeros(1) # -log p of each beam
+        state = self.initial_state(1)
+        tokens = np.array([init])
+        finished = []
+        for t in xrange(maxlen):
+            state, logp = self.step(state, tokens)
+            cost = np.subtract(scores.reshape(-1,1), logp, out=logp).ravel()
+            # at most one candidate per beam ends, so this holds width live ones
+            k = min(width + len(beams), cost.size)
+            best = np.argpartition(cost, k-1)[:k]
+            best = best[np.argsort(cost[best])]
+            keep = []
+            for b in best:
+                if b % V == end:
+                    finished.append((beams[b // V]+[end], cost[b]))
+                elif len(keep) < width:
+                    keep.append(b)
+            finished.sort(key=lambda pair: pair[1])
+            del finished[width:]
+            keep = np.array(keep, dtype=int)
+            beams = [beams[b // V]+[b % V] for b in keep]
+            scores = cost[keep]
+            if len(beams) == 0:
+                break
+            if len(finished) == width and scores[0] >= finished[-1][1]:
+                break
+            state, tokens = state[keep // V], keep % V
+        finished += zip(beams, scores)
+        finished.sort(key=lambda pair: pair[1])
+        return finished[:width]
 
 
 class ExtraCreditRNNLM(RNNLM):
@@ -315,13 +599,11 @@ def adjust_loss(loss, funk, q, mode='basic'):
 
 def fill_unknowns(words,vocab):
     ret = words
-    p = np.array([freq for word, freq in dict(vocab["freq"]).items()])
-    #print "summize all probability -> ",np.sum(p)
-    for i in range(len(words)):
-        if words[i] == "UUUNKKK":
-            ret[i] = vocab.index[multinomial_sample(p)]
-        else:
-            ret[i] = words[i]
+    # unigram replacements, one cached alias table per vocab
+    unks = [i for i in range(len(words)) if words[i] == "UUUNKKK"]
+    draws = alias_sampler(vocab["freq"].values, key=vocab).sample(len(unks))
+    for i, w in zip(unks, draws):
+        ret[i] = vocab.index[w]
     return ret
 
 if __name__ == "__main__":
@@ -335,7 +617,9 @@ if __name__ == "__main__":
     import pandas as pd
 
     vocab = pd.read_table("data/lm/vocab.ptb.txt",header=None, sep="\s+", index_col=0, names=['count','freq'])
-    vocabsize = 6000
+    # sampled softmax makes training on the full vocabulary affordable
+    sampled = False
+    vocabsize = len(vocab) if sampled else 6000
     num_to_word = dict(enumerate(vocab.index[:vocabsize]))
     word_to_num = du.invert_dict(num_to_word)
 
@@ -371,13 +655,21 @@ if __name__ == "__main__":
     L0 = 0.1*np.random.randn(vocabsize,hdim)
     model = None
     loadData = True
+    minibatch = 1 # > 1 trains on padded length buckets of this many sentences
     #model.grad_check(np.array([1,2,3]),np.array([2,3,4]))
 
     if loadData == True:
         model = RNNLM(L0, U0=L0, alpha=0.1, rseed=10, bptt=bptt,loadData=True)
     else:
-        model = RNNLM(L0, U0=L0, alpha=0.1, rseed=10, bptt=bptt)
-        trainCost = model.train_sgd(X_train, Y_train)
+        if sampled:
+            model = SampledSoftmaxRNNLM(L0, U0=L0, noise=vocab.freq[:vocabsize].values, k=100,
+                                        alpha=0.1, rseed=10, bptt=bptt)
+        else:
+            model = RNNLM(L0, U0=L0, alpha=0.1, rseed=10, bptt=bptt)
+        idxiter = None
+        if minibatch > 1:
+            idxiter = model.bucketiter(map(len,Y_train), minibatch)
+        trainCost = model.train_sgd(X_train, Y_train, idxiter=idxiter)
         save_params("rnnlmWithW_hdim_%d_bptt_%d.L.npy"%(hdim,bptt), model.sparams.L)
         save_params("rnnlmWithW_hdim_%d_bptt_%d.U.npy"%(hdim,bptt), model.params.U)
         save_params("rnnlmWithW_hdim_%d_bptt_%d.W.npy"%(hdim,bptt), model.params.W)
@@ -390,11 +682,17 @@ if __name__ == "__main__":
         #print " ".join(seq_to_words(seq))
         print " ".join(fill_unknowns(seq_to_words(seq),vocab))
     
-    #dev_loss = model.compute_mean_loss(X_dev, Y_dev)
+    #J, _ = model.compute_batch_loss(X_dev, Y_dev)
+    #dev_loss = J / float(sum(map(len,Y_dev)))
     #q = vocab.freq[vocabsize]/np.sum(vocab.freq[vocabsize:])
     #print "Unadjusted: %.03f" % np.exp(dev_loss)
     #print "Adjusted for missing vocab: %.03f" % np.exp(adjust_loss(dev_loss,fraction_lost,q))
 
+    # streaming perplexity, without loading the corpus
+    #seqs = du.iter_indices(du.iter_dataset('data/lm/ptb-test.txt'), word_to_num)
+    #J, ntot = model.compute_stream_loss(seqs, carry=True)
+    #print "Streamed test perplexity: %.03f" % np.exp(J/ntot)
+
     
     
     
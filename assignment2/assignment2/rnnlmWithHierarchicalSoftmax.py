@@ -6,13 +6,13 @@ import sys
 import cPickle as pickle
 
 # Import NN utils
-from nn.base import NNBase
-from nn.math import softmax, sigmoid, sigmoidGrad,make_onehot
-from nn.math import MultinomialSampler, multinomial_sample,HierarchicalSoftmaxTree
+from nn.base import NNBase, BatchedLMMixin
+from nn.math import softmax, sigmoid, sigmoidGrad,make_onehot, sum_rows
+from nn.math import MultinomialSampler, multinomial_sample,HierarchicalSoftmaxTree, alias_sampler
 from misc import random_weight_matrix
 
 
-class RNNLM(NNBase):
+class RNNLM(BatchedLMMixin, NNBase):
     """
     Implements an RNN language model of the form:
     h(t) = sigmoid(H * h(t-1) + L[x(t)])                    #  h(t) = sigmoid(H*h(t-1) + W*L[x(t)])
@@ -113,7 +113,7 @@ class RNNLM(NNBase):
             ps[i+1] = softmax(self.params.U.dot(hs[i+1]))
         ##
         # Backward propagation through time
-        sgradsTmp = np.zeros((self.vdim,self.hdim)) 
+        sgradsTmp = np.zeros((ns,self.hdim)) # dJ/dL[xs[t]], one row per t
         grad0 = np.zeros((ns+1,self.hdim)) # (y-t)*U 
         for i in range(ns):
             grad0[i+1] = (ps[i+1]-make_onehot(ys[i],self.vdim)).dot(self.params.U)
@@ -124,7 +124,7 @@ class RNNLM(NNBase):
                 self.grads.H += np.diag(vectorCurrent).dot(xh1)
                 x1 = np.ones((self.hdim, self.hdim)).dot(np.diag(self.sparams.L[xs[i-j]]))
                 self.grads.W += np.diag(vectorCurrent).dot(x1)
-                sgradsTmp[xs[i-j]] += vectorCurrent.dot(self.params.W)
+                sgradsTmp[i-j] += vectorCurrent.dot(self.params.W)
                 
                 vectorCurrent = vectorCurrent.dot(self.params.H)
                 vectorCurrent = vectorCurrent*sigmoidGrad(zs[i-j])
@@ -133,8 +133,10 @@ class RNNLM(NNBase):
         self.grads.H += self.lreg*self.params.H
         self.grads.W += self.lreg*self.params.W
         
-        for i in range(len(sgradsTmp)):
-            self.sgrads.L[i] = sgradsTmp[i,:]
+        # emit only the rows of L this sentence touched
+        words, dL = sum_rows(xs, sgradsTmp)
+        for i in range(len(words)):
+            self.sgrads.L[words[i]] = dL[i]
         #### END YOUR CODE ####
 
 
@@ -205,6 +207,22 @@ class RNNLM(NNBase):
         return J / float(ntot)
 
 
+    def _batch_hidden(self, h, x):
+        """One timestep for a batch: rows of h are the previous states."""
+        return sigmoid(h.dot(self.params.H.T) + self.sparams.L[x].dot(self.params.W.T))
+
+    def _batch_point_losses(self, h, y):
+        """-log p(y[j]|h[j]) for every row, as one product with U."""
+        z = h.dot(self.params.U.T)
+        zmax = z.max(axis=1)
+        logZ = zmax + np.log(np.sum(np.exp(z - zmax.reshape(-1,1)), axis=1))
+        return logZ - z[np.arange(len(y)), y]
+
+    def _batch_reg_loss(self, Y):
+        """The regularization term compute_seq_loss adds per sentence."""
+        return 0.5*self.lreg*(np.sum(self.params.H**2)+np.sum(self.params.W**2)+np.sum(self.params.U**2))
+
+
     def generate_sequence(self, init, end, maxlen=100):
         """
         Generate a sequence from the language model,
@@ -262,12 +280,12 @@ class ExtensionRNNLM(RNNLM):
     you've been using for the NER and RNNLM models.
     """
     
-    def __init__(self, L0, U0=None,alpha=0.005, lreg = 0.00001, rseed=10, bptt=1):
+    def __init__(self, L0, U0=None,alpha=0.005, lreg = 0.00001, rseed=10, bptt=1, counts=None):
         #### YOUR CODE HERE ####
         
-        RNNLM.__init__(self,L0,alpha,lreg,rseed,bptt)
-        self.word2node = {}
-        self.hierarchicalU = HierarchicalSoftmaxTree(L0.shape[0],L0.shape[1],self.word2node)
+        RNNLM.__init__(self,L0,U0,alpha=alpha,lreg=lreg,rseed=rseed,bptt=bptt)
+        # counts (e.g. from vocab.ptb.txt) give a Huffman coded tree
+        self.hierarchicalU = HierarchicalSoftmaxTree(L0.shape[0],L0.shape[1],counts)
 
         #print self.params.names()
         #raise NotImplementedError("__init__() not yet implemented.")
@@ -280,8 +298,6 @@ class ExtensionRNNLM(RNNLM):
         # make matrix here of corresponding h(t)
         # hs[-1] = initial hidden state (zeros)
         hs = np.zeros((ns+1, self.hdim))
-        # predicted probas
-        ps = np.zeros((ns+1, self.vdim))
 
         #### YOUR CODE HERE ####
         ##
@@ -294,102 +310,70 @@ class ExtensionRNNLM(RNNLM):
             
         ##
         # Backward propagation through time
-        sgradsTmp = np.zeros((self.vdim,self.hdim)) 
-        grad0 = np.zeros((ns+1,self.hdim)) # (y-t)*U 
+        # dJ/dh(t) from the internal nodes on each target's path,
+        # whose (regularized) gradients the tree accumulates itself
+        grad0 = self.hierarchicalU.acc_grads(hs[1:], ys, self.lreg)
+        sgz = sigmoidGrad(zs)
+
+        # deltas[t] sums every error that reaches z(t+1) within its bptt
+        # window, all of which share the inputs h(t) and L[x(t)]
+        deltas = np.zeros((ns,self.hdim))
         for i in range(ns):
-            nodeCur = self.word2node[ys[i]]
-            while nodeCur.parent != None:
-                t = 1
-                if nodeCur.isLeft == False:
-                    t = 0
-                nodeCur = nodeCur.parent
-                if nodeCur.grad == None:
-                    nodeCur.grad = (sigmoid(nodeCur.hActs.dot(hs[i+1]))-t)*hs[i+1]
-                else:
-                    nodeCur.grad = nodeCur.grad + (sigmoid(nodeCur.hActs.dot(hs[i+1]))-t)*hs[i+1]
-                    
-                grad0[i+1] = grad0[i+1] + (sigmoid(nodeCur.hActs.dot(hs[i+1]))-t)*nodeCur.hActs
-
-                    
-            vectorCurrent = grad0[i+1]*sigmoidGrad(zs[i+1])
+            vectorCurrent = grad0[i]*sgz[i+1]
             for j in range(min(i+1,self.bptt+1)):
-                xh1 = np.ones((self.hdim, self.hdim)).dot(np.diag(hs[i-j]))
-                self.grads.H += np.diag(vectorCurrent).dot(xh1)
-                x1 = np.ones((self.hdim, self.hdim)).dot(np.diag(self.sparams.L[xs[i-j]]))
-                self.grads.W += np.diag(vectorCurrent).dot(x1)
-                sgradsTmp[xs[i-j]] += vectorCurrent.dot(self.params.W)
-                
+                deltas[i-j] += vectorCurrent
                 vectorCurrent = vectorCurrent.dot(self.params.H)
-                vectorCurrent = vectorCurrent*sigmoidGrad(zs[i-j])
+                vectorCurrent = vectorCurrent*sgz[i-j]
 
-        
-        self.hierarchicalU.regularizedGrad(self.hierarchicalU.root,self.lreg)
+        self.grads.H += deltas.T.dot(hs[:-1])
+        self.grads.W += deltas.T.dot(self.sparams.L[xs])
         self.grads.H += self.lreg*self.params.H
         self.grads.W += self.lreg*self.params.W
         
-        for i in range(len(sgradsTmp)):
-            self.sgrads.L[i] = sgradsTmp[i,:]
+        # emit only the rows of L this sentence touched
+        words, dL = sum_rows(xs, deltas.dot(self.params.W))
+        for i in range(len(words)):
+            self.sgrads.L[words[i]] = dL[i]
         #### END YOUR CODE ####
 
+    def _acc_batch_grads(self, X, Y):
+        """
+        Accumulates the same gradients as _acc_grads on every sentence
+        of X, Y in turn, running them as one padded batch; see
+        BatchedLMMixin._batch_forward. The tree sees all real timesteps
+        of the batch in one acc_grads call.
+        """
+        xs, ys, counts, mask, hs = self._batch_forward(X, Y)
+        ns, nb = xs.shape
 
-
-
-    def _acc_grads1(self, xs, ys):
-        #### YOUR CODE HERE ####
-        # Expect xs as list of indices
-        ns = len(xs)
-        # make matrix here of corresponding h(t)
-        # hs[-1] = initial hidden state (zeros)
-        hs = np.zeros((ns+1, self.hdim))
-        # predicted probas
-        ps = np.zeros((ns+1, self.vdim))
-
-        #### YOUR CODE HERE ####
         ##
-        # Forward propagation
-
-        zs = np.zeros((ns+1,self.hdim))
-        for i in range(ns):
-            zs[i+1] = self.params.H.dot(hs[i]) + self.params.W.dot(self.sparams.L[xs[i]])
-            hs[i+1] = sigmoid(zs[i+1])
-            
-        ##
-        # Backward propagation through time
-        sgradsTmp = np.zeros((self.vdim,self.hdim)) 
-        grad0 = np.zeros((ns+1,self.hdim)) # (y-t)*U 
-        for i in range(ns):
-            nodeCur = self.word2node[ys[i]]
-            while nodeCur.parent != None:
-                t = 1
-                if nodeCur.isLeft == False:
-                    t = 0
-                nodeCur = nodeCur.parent
-                if nodeCur.grad == None:
-                    nodeCur.grad = (sigmoid(nodeCur.hActs.dot(hs[i+1]))-t)*hs[i+1]
-                else:
-                    nodeCur.grad = nodeCur.grad + (sigmoid(nodeCur.hActs.dot(hs[i+1]))-t)*hs[i+1]
-                grad0[i+1] = grad0[i+1] + (sigmoid(nodeCur.hActs.dot(hs[i+1]))-t)*nodeCur.hActs
-                
-            vectorCurrent = grad0[i+1]*sigmoidGrad(zs[i+1])
-            for j in range(min(i+1,self.bptt+1)):
-                xh1 = np.ones((self.hdim, self.hdim)).dot(np.diag(hs[i-j]))
-                self.grads.H += np.diag(vectorCurrent).dot(xh1)
-                x1 = np.ones((self.hdim, self.hdim)).dot(np.diag(self.sparams.L[xs[i-j]]))
-                self.grads.W += np.diag(vectorCurrent).dot(x1)
-                sgradsTmp[xs[i-j]] += vectorCurrent.dot(self.params.W)
-                
-                vectorCurrent = vectorCurrent.dot(self.params.H)
-                vectorCurrent = vectorCurrent*sigmoidGrad(zs[i-j])
+        # Tree on all real timesteps at once, then BPTT
+        seqs = np.tile(np.arange(nb), (ns,1))[mask]
+        grad0 = np.zeros((ns, nb, self.hdim))
+        grad0[mask] = self.hierarchicalU.acc_grads(hs[1:][mask], ys[mask],
+                                                   self.lreg, seqs)
+        deltas = self._batch_bptt(grad0, hs, counts)[mask]
+        self.grads.H += deltas.T.dot(hs[:-1][mask])
+        self.grads.W += deltas.T.dot(self.sparams.L[xs[mask]])
+
+        # regularization, once per sentence as in _acc_grads
+        self.grads.H += len(X)*self.lreg*self.params.H
+        self.grads.W += len(X)*self.lreg*self.params.W
+
+        words, dL = sum_rows(xs[mask], deltas.dot(self.params.W))
+        for i in range(len(words)):
+            self.sgrads.L[words[i]] = dL[i]
+
+    def train_minibatch_sgd(self, X, y, alpha):
+        """
+        Minibatch SGD on the summed gradient of the sentences, computed
+        as one padded batch. Minibatches of similar length waste the
+        least work, see NNBase.bucketiter.
+        """
+        self._reset_grad_acc()
+        self._acc_batch_grads(X, y)
+        self._apply_grad_acc(alpha)
 
-        
-        self.hierarchicalU.regularizedGrad(self.hierarchicalU.root,self.lreg)
-        self.grads.H += self.lreg*self.params.H
-        self.grads.W += self.lreg*self.params.W
-        
-        for i in range(len(sgradsTmp)):
-            self.sgrads.L[i] = sgradsTmp[i,:]
-        #### END YOUR CODE ####
-        
     def compute_seq_loss(self, xs, ys):
         """
         Compute the total cross-entropy loss
@@ -407,18 +391,20 @@ class ExtensionRNNLM(RNNLM):
         hs = np.zeros((ns+1,self.hdim))
         for i in range(ns):
             hs[i+1] = sigmoid(self.params.H.dot(hs[i])+self.params.W.dot(self.sparams.L[xs[i]]))
-            nodeCur = self.word2node[ys[i]]
-            while nodeCur.parent != None:
-                t = 1
-                if nodeCur.isLeft == False:
-                    t = -1
-                nodeCur = nodeCur.parent
-                J += -np.log(sigmoid(t*nodeCur.hActs.dot(hs[i+1])))
+        J += self.hierarchicalU.seq_loss(hs[1:], ys)
         #### END YOUR CODE ####
-        x = self.hierarchicalU.getSumSquareU(self.hierarchicalU.root)
+        # only the internal nodes on the paths of ys are regularized
+        x = self.hierarchicalU.sum_square(ys)
         Jreg = 0.5*self.lreg*(np.sum(self.params.H**2)+np.sum(self.params.W**2) + x)
         return J + Jreg
 
+    def _batch_point_losses(self, h, y):
+        return self.hierarchicalU.point_losses(h, y)
+
+    def _batch_reg_loss(self, Y):
+        x = np.array([self.hierarchicalU.sum_square(ys) for ys in Y])
+        return 0.5*self.lreg*(np.sum(self.params.H**2)+np.sum(self.params.W**2) + x)
+
     def generate_sequence(self, init, end, maxlen=100):
         """
         Generate a sequence from the language model,
@@ -451,18 +437,17 @@ class ExtensionRNNLM(RNNLM):
         #### YOUR CODE HERE ####
         for i in range(ns):
             hs[i+1] = sigmoid(self.params.H.dot(hs[i])+self.params.W.dot(self.sparams.L[ys[i]]))            
-            p = self.hierarchicalU.getDistribution(hs[i+1])
-            y = multinomial_sample(p)
+            # walk down the tree instead of building the full distribution
+            y, logp = self.hierarchicalU.sample(hs[i+1])
             ys.append(y)
             if y == end:
                 break
-            p = p*make_onehot(y,self.vdim)
-            J += -np.log(np.sum(p))
+            J += -logp
 
 
         ##
         #x only compute the node which gradient is updated 
-        x = self.hierarchicalU.getSumSquareU(self.hierarchicalU.root)
+        x = self.hierarchicalU.sum_square(ys[1:])
         Jreg = 0.5*self.lreg*(np.sum(self.params.H**2)+np.sum(self.params.W**2)+ x)
         #### YOUR CODE HERE ####
         return ys, J+Jreg
@@ -476,7 +461,7 @@ class ExtensionRNNLM(RNNLM):
         """Reset accumulated gradients."""
         self.grads.reset()
         self.sgrads.reset()
-        self.hierarchicalU.reset(self.hierarchicalU.root)
+        self.hierarchicalU.reset()
         
     def _apply_grad_acc(self, alpha=1.0):
         """
@@ -491,7 +476,7 @@ class ExtensionRNNLM(RNNLM):
         # Sparse updates
         self.sgrads.apply_to(self.sparams, alpha=-1*alpha)
         # hierarchical softmax U
-        self.hierarchicalU.apply_grad_acc(self.hierarchicalU.root, alpha=-1*alpha)        
+        self.hierarchicalU.apply_grad_acc(alpha=-1*alpha)        
 
 ########################################################
     #we need this grad_check ,because although the member variable
@@ -502,26 +487,22 @@ class ExtensionRNNLM(RNNLM):
     #if you define a object variable exclaimed as RNNLM, it will come
     #error
 
-    def grad_check_hierarchicalU(self,node,grad_computed,grad_approx,eps,x,y):
-        if node.isLeaf == True:
-            return
-        if node.grad == None:
-            return
-
-        theta = node.hActs
-        for ij,v in np.ndenumerate(node.hActs):
-            tij = theta[ij]
-            theta[ij] = tij + eps
-            Jplus = self.compute_loss(x,y)
-            theta[ij] = tij - eps
-            Jminus = self.compute_loss(x, y)
-            theta[ij] = tij # reset
-            approx = (Jplus - Jminus)/(2*eps)
-            grad_computed.append(node.grad[ij])
-            grad_approx.append(approx)
-
-        self.grad_check_hierarchicalU(node.left,grad_computed,grad_approx,eps,x,y)
-        self.grad_check_hierarchicalU(node.right,grad_computed,grad_approx,eps,x,y)
+    def grad_check_hierarchicalU(self,grad_computed,grad_approx,eps,x,y):
+        # only the touched internal nodes have a gradient
+        nodes, dU = self.hierarchicalU.grads()
+        theta = self.hierarchicalU.U
+        for k in range(len(nodes)):
+            for j in range(theta.shape[1]):
+                ij = (nodes[k], j)
+                tij = theta[ij]
+                theta[ij] = tij + eps
+                Jplus = self.compute_loss(x,y)
+                theta[ij] = tij - eps
+                Jminus = self.compute_loss(x, y)
+                theta[ij] = tij # reset
+                approx = (Jplus - Jminus)/(2*eps)
+                grad_computed.append(dU[k,j])
+                grad_approx.append(approx)
         
             
     def grad_check(self, x, y, eps=1e-4, tol=1e-6,
@@ -580,7 +561,7 @@ class ExtensionRNNLM(RNNLM):
         grad_computed = []
         grad_approx = []
         name = "softmaxU"
-        self.grad_check_hierarchicalU(self.hierarchicalU.root,grad_computed,grad_approx,eps,x,y)
+        self.grad_check_hierarchicalU(grad_computed,grad_approx,eps,x,y)
         grad_computed = np.array(grad_computed)
         grad_approx = np.array(grad_approx)
         grad_delta = linalg.norm(grad_approx - grad_computed)
@@ -653,13 +634,11 @@ def adjust_loss(loss, funk, q, mode='basic'):
 
 def fill_unknowns(words,vocab):
     ret = words
-    p = np.array([freq for word, freq in dict(vocab["freq"]).items()])
-    #print "summize all probability -> ",np.sum(p)
-    for i in range(len(words)):
-        if words[i] == "UUUNKKK":
-            ret[i] = vocab.index[multinomial_sample(p)]
-        else:
-            ret[i] = words[i]
+    # unigram replacements, one cached alias table per vocab
+    unks = [i for i in range(len(words)) if words[i] == "UUUNKKK"]
+    draws = alias_sampler(vocab["freq"].values, key=vocab).sample(len(unks))
+    for i, w in zip(unks, draws):
+        ret[i] = vocab.index[w]
     return ret
 
 
@@ -714,7 +693,9 @@ if __name__ == "__main__":
     hdim = 20
     random.seed(10)
     L0 = 0.1*np.random.randn(vocabsize,hdim) 
-    model = ExtensionRNNLM(L0, U0=L0, alpha=0.1, rseed=10, bptt=3)
+    huffman = True # Huffman code the tree by corpus frequency
+    counts = np.array(vocab['count'][:vocabsize]) if huffman else None
+    model = ExtensionRNNLM(L0, U0=L0, alpha=0.1, rseed=10, bptt=3, counts=counts)
     #model.grad_check(np.array([1,2,3,4]),np.array([2,3,4,5]))
 
     idxiter = Generator(Y_train)
@@ -732,7 +713,8 @@ if __name__ == "__main__":
     #     #print " ".join(seq_to_words(seq))
     #     print " ".join(fill_unknowns(seq_to_words(seq),vocab))
     
-    # dev_loss = model.compute_mean_loss(X_dev, Y_dev)
+    # J, _ = model.compute_batch_loss(X_dev, Y_dev)
+    # dev_loss = J / float(sum(map(len,Y_dev)))
     # q = vocab.freq[vocabsize]/np.sum(vocab.freq[vocabsize:])
     # print "Unadjusted: %.03f" % np.exp(dev_loss)
     # print "Adjusted for missing vocab: %.03f" % np.exp(adjust_loss(dev_loss,fraction_lost,q))
@@ -5,13 +5,13 @@ import time
 import sys
 import cPickle as pickle
 # Import NN utils
-from nn.base import NNBase
-from nn.math import softmax, sigmoid, sigmoidGrad,make_onehot
+from nn.base import NNBase, BatchedLMMixin
+from nn.math import softmax, sigmoid, sigmoidGrad,make_onehot, sum_rows
 from nn.math import MultinomialSampler, multinomial_sample
 from misc import random_weight_matrix
 
 
-class RNNLM(NNBase):
+class RNNLM(BatchedLMMixin, NNBase):
     """
     Implements an RNN language model of the form:
     h(t) = sigmoid(H * h(t-1) + L[x(t)])                    #  h(t) = sigmoid(H*h(t-1) + W*L[x(t)])
@@ -111,7 +111,7 @@ class RNNLM(NNBase):
             ps[i+1] = softmax(self.params.U.dot(hs[i+1]))
         ##
         # Backward propagation through time
-        sgradsTmp = np.zeros((self.vdim,self.hdim)) 
+        sgradsTmp = np.zeros((ns,self.hdim)) # dJ/dL[xs[t]], one row per t
         grad0 = np.zeros((ns+1,self.hdim)) # (y-t)*U 
         for i in range(ns):
             grad0[i+1] = (ps[i+1]-make_onehot(ys[i],self.vdim)).dot(self.params.U)
@@ -120,14 +120,51 @@ class RNNLM(NNBase):
             for j in range(min(i+1,self.bptt+1)):
                 xh1 = np.ones((self.hdim, self.hdim)).dot(np.diag(hs[i-j]))
                 self.grads.H += np.diag(vectorCurrent).dot(xh1)
-                sgradsTmp[xs[i-j]] += vectorCurrent
+                sgradsTmp[i-j] += vectorCurrent
                 
                 vectorCurrent = vectorCurrent.dot(self.params.H)
                 vectorCurrent = vectorCurrent*sigmoidGrad(zs[i-j])
-        for i in range(len(sgradsTmp)):
-            self.sgrads.L[i] = sgradsTmp[i,:]
+        # emit only the rows of L this sentence touched
+        words, dL = sum_rows(xs, sgradsTmp)
+        for i in range(len(words)):
+            self.sgrads.L[words[i]] = dL[i]
         #### END YOUR CODE ####
 
+    def _acc_batch_grads(self, X, Y):
+        """
+        Accumulates the same gradients as _acc_grads on every sentence
+        of X, Y in turn, running them as one padded batch; see
+        BatchedLMMixin._batch_forward. Without W, dJ/dL[x(t)] is just
+        the delta at t.
+        """
+        xs, ys, counts, mask, hs = self._batch_forward(X, Y)
+        ns, nb = xs.shape
+
+        ##
+        # Output layer on all real timesteps at once, then BPTT
+        h = hs[1:][mask]
+        dys = softmax(h.dot(self.params.U.T))
+        dys[np.arange(len(dys)), ys[mask]] -= 1
+        self.grads.U += dys.T.dot(h)
+        grad0 = np.zeros((ns, nb, self.hdim))
+        grad0[mask] = dys.dot(self.params.U)
+        deltas = self._batch_bptt(grad0, hs, counts)[mask]
+        self.grads.H += deltas.T.dot(hs[:-1][mask])
+
+        words, dL = sum_rows(xs[mask], deltas)
+        for i in range(len(words)):
+            self.sgrads.L[words[i]] = dL[i]
+
+    def train_minibatch_sgd(self, X, y, alpha):
+        """
+        Minibatch SGD on the summed gradient of the sentences, computed
+        as one padded batch. Minibatches of similar length waste the
+        least work, see NNBase.bucketiter.
+        """
+        self._reset_grad_acc()
+        self._acc_batch_grads(X, y)
+        self._apply_grad_acc(alpha)
+
 
     def grad_check(self, x, y, outfd=sys.stderr, **kwargs):
         """
@@ -194,6 +231,22 @@ class RNNLM(NNBase):
         return J / float(ntot)
 
 
+    def _batch_hidden(self, h, x):
+        """One timestep for a batch: rows of h are the previous states."""
+        return sigmoid(h.dot(self.params.H.T) + self.sparams.L[x])
+
+    def _batch_point_losses(self, h, y):
+        """-log p(y[j]|h[j]) for every row, as one product with U."""
+        z = h.dot(self.params.U.T)
+        zmax = z.max(axis=1)
+        logZ = zmax + np.log(np.sum(np.exp(z - zmax.reshape(-1,1)), axis=1))
+        return logZ - z[np.arange(len(y)), y]
+
+    def _batch_reg_loss(self, Y):
+        """compute_seq_loss adds no regularization here."""
+        return 0.0
+
+
     def generate_sequence(self, init, end, maxlen=100):
         """
         Generate a sequence from the language model,
@@ -339,7 +392,8 @@ if __name__ == "__main__":
     print J
     print " ".join([num_to_word[s] for s in seq])
     
-    dev_loss = model.compute_mean_loss(X_dev, Y_dev)
+    J, _ = model.compute_batch_loss(X_dev, Y_dev)
+    dev_loss = J / float(sum(map(len,Y_dev)))
     q = vocab.freq[vocabsize]/np.sum(vocab.freq[vocabsize:])
     print "Unadjusted: %.03f" % np.exp(dev_loss)
     print "Adjusted for missing vocab: %.03f" % np.exp(adjust_loss(dev_loss,fraction_lost,q))
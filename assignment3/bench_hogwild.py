@@ -0,0 +1,29 @@
+import sys
+import random
+import numpy as np
+import tree as tr
+import sgd as optimizer
+from rnn import RNN
+from runNNet import evaluate
+
+# Convergence and throughput of hogwild against the synchronous adagrad
+# loop, using the batched RNN.
+# Run from this directory: python bench_hogwild.py [workers] [epochs]
+
+if __name__ == '__main__':
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    epochs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    trees = tr.loadTrees('train',compiled=True)
+    dev_trees = tr.loadTrees('dev',compiled=True)
+    numWords = len(tr.loadWordMap())
+
+    for opt,w in [('adagrad',1),('hogwild',workers)]:
+        random.seed(10)
+        nn = RNN(30,5,numWords,30,batched=True)
+        nn.initParams()
+        sgd = optimizer.SGD(nn,alpha=1e-2,minibatch=30,optimizer=opt,workers=w)
+        for e in range(epochs):
+            sgd.run(trees)
+            cost,acc,_ = evaluate(nn,dev_trees)
+            print "%s x%d epoch %d: %.1f trees/sec, dev cost %.4f, dev acc %.4f"%(
+                opt,w,e,sgd.treesPerSec[-1],cost,acc)
@@ -0,0 +1,44 @@
+import time
+import tree as tr
+
+# Compares the old loadTrees (recursive list-slicing parser, then a
+# mapWords traversal) with the streaming stack parser, and with loadTrees
+# now, which links Nodes from the binary tree cache (built on first use).
+# Run from this directory: python bench_loadtrees.py
+
+def sameTree(a,b):
+    if a.label != b.label or a.isLeaf != b.isLeaf or a.word != b.word:
+        return False
+    if a.isLeaf:
+        return True
+    return sameTree(a.left,b.left) and sameTree(a.right,b.right)
+
+def loadTreesOld(dataSet):
+    wordMap = tr.loadWordMap()
+    with open('trees/%s.txt'%dataSet,'r') as fid:
+        trees = [tr.Tree(l,linear=False) for l in fid.readlines()]
+    for tree in trees:
+        tr.leftTraverse(tree.root,nodeFn=tr.mapWords,args=wordMap)
+    return trees
+
+if __name__ == '__main__':
+    for dataSet in ['train','dev','test']:
+        start = time.time()
+        old = loadTreesOld(dataSet)
+        tOld = time.time()-start
+
+        start = time.time()
+        parsed = list(tr.iterTrees(dataSet,tr.loadWordMap()))
+        tParse = time.time()-start
+
+        tr.loadTrees(dataSet,compiled=True) # make sure the cache exists
+        start = time.time()
+        new = tr.loadTrees(dataSet)
+        tNew = time.time()-start
+
+        same = len(old) == len(new) == len(parsed) and all(
+            sameTree(a.root,b.root) and sameTree(a.root,c.root)
+            for a,b,c in zip(old,new,parsed))
+        print "%5s: %d trees, old %.3fs, parse %.3fs, cached %.3fs (%.1fx), identical=%s"%(
+            dataSet,len(new),tOld,tParse,tNew,tOld/tNew,same)
+        del old,new,parsed
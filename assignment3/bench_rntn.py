@@ -0,0 +1,64 @@
+import sys
+import time
+import numpy as np
+import tree as tr
+from rntn import RNTN
+
+# Per-epoch time of the RNTN tensor layer: the old per-slice loops
+# (recursive path) and einsum (batched path) against the reshaped GEMMs
+# of RNTN.tensorProd/tensorGrad, at a few word vector sizes.
+# Run from this directory: python bench_rntn.py [numTrees]
+
+class LoopRNTN(RNTN):
+    """The tensor layer as it was, one slice of V at a time."""
+
+    def tensorProd(self,h):
+        tmp = np.zeros((h.shape[0],self.wvecDim))
+        for i in range(self.wvecDim):
+            tmp[:,i] = np.sum(h.dot(self.V[i])*h,axis=1)
+        return tmp
+
+    def tensorGrad(self,errorCur,LR):
+        S = np.zeros(LR.shape)
+        for i in range(self.wvecDim):
+            self.dV[i] += (errorCur[:,i,None]*LR).T.dot(LR)
+            S += LR.dot((self.V[i]+self.V[i].T).T)*errorCur[:,i,None]
+        return S
+
+class EinsumRNTN(RNTN):
+    """The tensor layer as three-operand einsums."""
+
+    def tensorProd(self,h):
+        return np.einsum('nj,ijk,nk->ni',h,self.V,h)
+
+    def tensorGrad(self,errorCur,LR):
+        self.dV += np.einsum('ni,nj,nk->ijk',errorCur,LR,LR)
+        return np.einsum('ni,ijk,nk->nj',errorCur,self.VVt,LR)
+
+def epochTime(nn,trees,mbSize=30):
+    start = time.time()
+    for i in xrange(0,len(trees)-mbSize+1,mbSize):
+        nn.costAndGrad(trees[i:i+mbSize])
+    return time.time()-start
+
+if __name__ == '__main__':
+    m = int(sys.argv[1]) if len(sys.argv) > 1 else 1500
+    trees = tr.loadTrees('train')[:m]
+    compiled = [tr.CompiledTree(t) for t in trees]
+    numWords = len(tr.loadWordMap())
+
+    for wvecDim in [25,30,50]:
+        times = {}
+        grads = {}
+        for name,cls,batched in [('loop',LoopRNTN,False),('gemm',RNTN,False),
+                                 ('einsum',EinsumRNTN,True),('gemm',RNTN,True)]:
+            nn = cls(wvecDim,5,numWords,30,batched=batched)
+            nn.initParams()
+            key = ('batched ' if batched else 'recursive ')+name
+            times[key] = epochTime(nn,compiled if batched else trees)
+            grads[key] = [np.array(g) for g in nn.costAndGrad(trees[:30])[1][1:]]
+        ref = grads['recursive loop']
+        for key in sorted(times):
+            err = max(np.abs(g-r).max() for g,r in zip(grads[key],ref))
+            print "wvecDim %d, %-16s: %.2fs per %d trees (max grad diff %.1e)"%(
+                wvecDim,key,times[key],m,err)
@@ -0,0 +1,58 @@
+import sys
+import time
+import random
+import numpy as np
+import tree as tr
+import sgd as optimizer
+from rntn import RNTN
+
+# Cost of the dense parameter updates over one RNTN epoch: the in-place
+# updateParams against rebuilding the stack with fresh arrays each step.
+# Uses tracemalloc for the allocated bytes where the interpreter has it
+# (python 3.4+), otherwise only reports time and array identity.
+# Run from this directory: python bench_updates.py [wvecDim] [numTrees]
+
+def rebuildParams(nn,scale,update,log=False):
+    """The previous updateParams, allocating a new array per param."""
+    nn.stack[1:] = [P+scale*dP for P,dP in zip(nn.stack[1:],update[1:])]
+    cols,dL = update[0]
+    nn.L[:,cols] += scale*dL
+
+if __name__ == '__main__':
+    wvecDim = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    m = int(sys.argv[2]) if len(sys.argv) > 2 else 1500
+    trees = tr.loadTrees('train',compiled=True)[:m]
+    numWords = len(tr.loadWordMap())
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+
+    for name in ['rebuild','inplace']:
+        random.seed(10)
+        nn = RNTN(wvecDim,5,numWords,30,batched=True)
+        nn.initParams()
+        sgd = optimizer.SGD(nn,alpha=1e-2,minibatch=30,optimizer='adagrad')
+        ids = [id(P) for P in nn.stack]
+
+        update = nn.updateParams
+        if name == 'rebuild':
+            update = lambda *args,**kw: rebuildParams(nn,*args,**kw)
+        stats = {'time':0.0,'bytes':0}
+        def timed(scale,grad,log=False):
+            if tracemalloc is not None:
+                tracemalloc.start()
+            start = time.time()
+            update(scale,grad,log)
+            stats['time'] += time.time()-start
+            if tracemalloc is not None:
+                stats['bytes'] += tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+        nn.updateParams = timed
+
+        sgd.run(trees)
+        kept = all(id(P) == i for P,i in zip(nn.stack,ids))
+        print "%s: %d steps, %.3fs in updateParams, stack arrays kept: %s"%(
+            name,sgd.it,stats['time'],kept)
+        if tracemalloc is not None:
+            print "  peak bytes allocated per step: %d"%(stats['bytes']//sgd.it)
@@ -8,9 +8,11 @@ def sigmoidGrad(x):
     return sigmoid(x)*(1-sigmoid(x))
 
 def softmax(x):
-    #x = x-x.max(axis=1).reshape(x.shape[0],1)
-    #b = np.sum(np.exp(x),axis=1)
-    #x = np.exp(x)/b.reshape(x.shape[0],1)
+    if x.ndim == 2: # one distribution per row
+        x = x-x.max(axis=1).reshape(x.shape[0],1)
+        b = np.sum(np.exp(x),axis=1)
+        x = np.exp(x)/b.reshape(x.shape[0],1)
+        return x
     x = x-x.max()
     b = np.sum(np.exp(x))
     x = np.exp(x)/b
@@ -21,6 +23,36 @@ def make_onehot(i, n):
     y[i] = 1
     return y
 
+##
+# Sparse gradients of a column-indexed matrix (e.g. the word vectors L)
+# are kept as a pair (cols, vals): an index array and an (n x len(cols))
+# matrix holding one gradient column per index, so updates can be done
+# as a single fancy-indexed operation like L[:,cols] += vals.
+
+def columns_from_dict(d, n):
+    """Converts a {column: vector} dict into a (cols, vals) pair."""
+    if len(d) == 0:
+        return np.zeros(0,dtype=int), np.zeros((n,0))
+    return np.array(d.keys()), np.array(d.values()).T
+
+def sum_columns(cols, vals):
+    """Sums the columns of vals that share an index, making cols unique."""
+    cols, inv = np.unique(cols, return_inverse=True)
+    out = np.zeros((vals.shape[0],len(cols)))
+    np.add.at(out.T, inv, vals.T)
+    return cols, out
+
+def axpby(a, x, b, y, buf):
+    """
+    Computes y = a*x + b*y in place. buf is preallocated scratch
+    shaped like x, so no temporary array is allocated.
+    """
+    np.multiply(x, a, out=buf)
+    if b != 1:
+        y *= b
+    y += buf
+    return y
+
 
 class MultinomialSampler(object):
     """
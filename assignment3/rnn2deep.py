@@ -1,7 +1,8 @@
 import numpy as np
 import collections
 import pdb
-from nn.math import softmax, make_onehot
+from nn.math import softmax, make_onehot, columns_from_dict, axpby
+from treebatch import TreeBatch
 
 # This is a 2-Layer Deep Recursive Neural Netowrk with two ReLU Layers and a softmax layer
 # You must update the forward and backward propogation functions of this file.
@@ -13,7 +14,7 @@ from nn.math import softmax, make_onehot
 
 class RNN2:
 
-    def __init__(self,wvecDim, middleDim, outputDim,numWords,mbSize=30,rho=1e-4):
+    def __init__(self,wvecDim, middleDim, outputDim,numWords,mbSize=30,rho=1e-4,batched=False):
         self.wvecDim = wvecDim
         self.outputDim = outputDim
         self.middleDim = middleDim
@@ -21,6 +22,7 @@ class RNN2:
         self.mbSize = mbSize
         self.defaultVec = lambda : np.zeros((wvecDim,))
         self.rho = rho
+        self.batched = batched # run whole tree levels as one matrix product
 
     def initParams(self):
         np.random.seed(12341)
@@ -52,6 +54,9 @@ class RNN2:
         self.dWs = np.empty(self.Ws.shape)
         self.dbs = np.empty((self.outputDim))
 
+        # Scratch space for in-place updates, one per dense param
+        self.buf = [np.empty(P.shape) for P in self.stack[1:]]
+
     def costAndGrad(self,mbdata,test=False): 
         """
         Each datum in the minibatch is a tree.
@@ -83,32 +88,47 @@ class RNN2:
         self.dbs[:] = 0
         self.dL = collections.defaultdict(self.defaultVec)
 
-        # Forward prop each tree in minibatch
-        for tree in mbdata: 
-            c,tot = self.forwardProp(tree.root,correct,guess)
-            cost += c
-            total += tot
-            
-        if test:
-            return (1./len(mbdata))*cost,correct, guess, total
+        if self.batched:
+            batch = TreeBatch(mbdata)
+            cost,total = self.forwardPropBatch(batch,correct,guess)
+            if test:
+                return (1./len(mbdata))*cost,correct, guess, total
+            self.backPropBatch(batch)
+        else:
+            # Forward prop each tree in minibatch
+            for tree in mbdata: 
+                c,tot = self.forwardProp(tree.root,correct,guess)
+                cost += c
+                total += tot
 
-        # Back prop each tree in minibatch
-        for tree in mbdata:
-            self.backProp(tree.root)
+            if test:
+                return (1./len(mbdata))*cost,correct, guess, total
+
+            # Back prop each tree in minibatch
+            for tree in mbdata:
+                self.backProp(tree.root)
+            self.dL = columns_from_dict(self.dL,self.wvecDim)
 
         # scale cost and grad by mb size
         scale = (1./self.mbSize)
-        for v in self.dL.itervalues():
-            v *=scale
+        cols,dL = self.dL
+        dL *= scale
         
         # Add L2 Regularization 
-        cost += (self.rho/2)*np.sum(self.W1**2)
-        cost += (self.rho/2)*np.sum(self.W2**2)
-        cost += (self.rho/2)*np.sum(self.Ws**2)
-
-        return scale*cost,[self.dL,scale*(self.dW1 + self.rho*self.W1),scale*self.db1,
-                                   scale*(self.dW2 + self.rho*self.W2),scale*self.db2,
-                                   scale*(self.dWs+self.rho*self.Ws),scale*self.dbs]
+        cost += (self.rho/2)*np.vdot(self.W1,self.W1)
+        cost += (self.rho/2)*np.vdot(self.W2,self.W2)
+        cost += (self.rho/2)*np.vdot(self.Ws,self.Ws)
+
+        # scale grads and add L2 regularization in place, the gradient
+        # buffers are reused (and overwritten) by the next call
+        axpby(scale*self.rho,self.W1,scale,self.dW1,self.buf[0])
+        self.db1 *= scale
+        axpby(scale*self.rho,self.W2,scale,self.dW2,self.buf[2])
+        self.db2 *= scale
+        axpby(scale*self.rho,self.Ws,scale,self.dWs,self.buf[4])
+        self.dbs *= scale
+        return scale*cost,[self.dL,self.dW1,self.db1,self.dW2,self.db2,
+                                   self.dWs,self.dbs]
 
     def ReLU(self,x):
         return x*(x > 0)
@@ -180,7 +200,59 @@ class RNN2:
         errorCur = errorCur.dot(self.W1)
         self.backProp(node.left,errorCur[:self.wvecDim])
         self.backProp(node.right,errorCur[self.wvecDim:])
-        
+
+    def forwardPropBatch(self,batch,correct=[],guess=[]):
+        """
+        Same as forwardProp but over a whole TreeBatch, one tree level
+        at a time. Activations live in batch.hActs1 (numNodes x wvecDim)
+        and batch.hActs2 (numNodes x middleDim).
+        """
+        hActs1 = np.empty((batch.numNodes,self.wvecDim))
+        hActs1[batch.leaves] = self.L[:,batch.leafWords].T
+        batch.inputs = []
+        for nodes in batch.levels:
+            l,r = batch.children(nodes)
+            h = np.hstack([hActs1[l],hActs1[r]])
+            hActs1[nodes] = self.ReLU(h.dot(self.W1.T) + self.b1)
+            batch.inputs.append(h)
+
+        hActs2 = self.ReLU(hActs1.dot(self.W2.T) + self.b2)
+        probs = softmax(hActs2.dot(self.Ws.T) + self.bs)
+        batch.hActs1 = hActs1
+        batch.hActs2 = hActs2
+        batch.probs = probs
+
+        correct.extend(batch.labels.tolist())
+        guess.extend(np.argmax(probs,axis=1).tolist())
+        cost = -np.sum(np.log(probs[np.arange(batch.numNodes),batch.labels]))
+        return cost, batch.numNodes
+
+    def backPropBatch(self,batch):
+        """
+        Same as backProp but over a whole TreeBatch, from the highest
+        level down to the leaves.
+        """
+        errorCur = batch.probs.copy()
+        errorCur[np.arange(batch.numNodes),batch.labels] -= 1
+        self.dWs += errorCur.T.dot(batch.hActs2)
+        self.dbs += np.sum(errorCur,axis=0)
+        errorCur = errorCur.dot(self.Ws)*self.df(batch.hActs2)
+        self.dW2 += errorCur.T.dot(batch.hActs1)
+        self.db2 += np.sum(errorCur,axis=0)
+
+        # errors from each node's softmax, children add what comes down
+        error = errorCur.dot(self.W2)
+        for nodes,h in reversed(zip(batch.levels,batch.inputs)):
+            errorCur = error[nodes]*self.df(batch.hActs1[nodes])
+            self.dW1 += errorCur.T.dot(h)
+            self.db1 += np.sum(errorCur,axis=0)
+            errorDown = errorCur.dot(self.W1)
+            l,r = batch.children(nodes)
+            error[l] += errorDown[:,:self.wvecDim]
+            error[r] += errorDown[:,self.wvecDim:]
+
+        self.dL = batch.wordGrads(error[batch.leaves])
+
         
     def updateParams(self,scale,update,log=False):
         """
@@ -195,12 +267,13 @@ class RNN2:
                 dpRMS = np.sqrt(np.mean((scale*dP)**2))
                 print "weight rms=%f -- update rms=%f"%(pRMS,dpRMS)
 
-        self.stack[1:] = [P+scale*dP for P,dP in zip(self.stack[1:],update[1:])]
+        # update dense params in place, reusing the scratch buffers
+        for P,dP,buf in zip(self.stack[1:],update[1:],self.buf):
+            axpby(scale,dP,1.0,P,buf)
 
-        # handle dictionary update sparsely
-        dL = update[0]
-        for j in dL.iterkeys():
-            self.L[:,j] += scale*dL[j]
+        # handle sparse columns of L in one fancy-indexed update
+        cols,dL = update[0]
+        self.L[:,cols] += scale*dL
 
     def toFile(self,fid):
         import cPickle as pickle
@@ -213,6 +286,7 @@ class RNN2:
     def check_grad(self,data,epsilon=1e-6):
 
         cost, grad = self.costAndGrad(data)
+        grad = grad[:1]+[dW.copy() for dW in grad[1:]] # buffers get reused
 
         err1 = 0.0
         count = 0.0
@@ -239,19 +313,19 @@ class RNN2:
             print "Grad Check Passed for dW Sum of Error = %.12f" % (err1/count)
         else:
             print "Grad Check Failed for dW: Sum of Error = %.12f" % (err1/count)
-        # check dL separately since dict
-        dL = grad[0]
+        # check dL separately since sparse
+        cols,dL = grad[0]
         L = self.stack[0]
         err2 = 0.0
         count = 0.0
         print "Checking dL..."
-        for j in dL.iterkeys():
+        for k,j in enumerate(cols):
             for i in xrange(L.shape[0]):
                 L[i,j] += epsilon
                 costP,_ = self.costAndGrad(data)
                 L[i,j] -= epsilon
                 numGrad = (costP - cost)/epsilon
-                err = np.abs(dL[j][i] - numGrad)
+                err = np.abs(dL[i,k] - numGrad)
                 err2+=err
                 count+=1
 
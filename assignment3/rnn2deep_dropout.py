@@ -1,7 +1,7 @@
 import numpy as np
 import collections
 import pdb
-from nn.math import softmax, make_onehot
+from nn.math import softmax, make_onehot, columns_from_dict, axpby
 
 # This is a 2-Layer Deep Recursive Neural Netowrk with two ReLU Layers and a softmax layer
 # You must update the forward and backward propogation functions of this file.
@@ -52,6 +52,9 @@ class RNN2Drop:
         self.dWs = np.empty(self.Ws.shape)
         self.dbs = np.empty((self.outputDim))
 
+        # Scratch space for in-place updates, one per dense param
+        self.buf = [np.empty(P.shape) for P in self.stack[1:]]
+
         self.dropoutP = 0.5
         self.mask = self.dropout(self.middleDim,self.dropoutP)
 
@@ -106,20 +109,28 @@ class RNN2Drop:
         # Back prop each tree in minibatch
         for tree in mbdata:
             self.backProp(tree.root)
+        self.dL = columns_from_dict(self.dL,self.wvecDim)
 
         # scale cost and grad by mb size
         scale = (1./self.mbSize)
-        for v in self.dL.itervalues():
-            v *=scale
+        cols,dL = self.dL
+        dL *= scale
         
         # Add L2 Regularization 
-        cost += (self.rho/2)*np.sum(self.W1**2)
-        cost += (self.rho/2)*np.sum(self.W2**2)
+        cost += (self.rho/2)*np.vdot(self.W1,self.W1)
+        cost += (self.rho/2)*np.vdot(self.W2,self.W2)
         cost += (self.rho/2)*np.sum((self.Ws.dot(np.diag(self.mask)))**2)
 
-        return scale*cost,[self.dL,scale*(self.dW1 + self.rho*self.W1),scale*self.db1,
-                                   scale*(self.dW2 + self.rho*self.W2),scale*self.db2,
-                                   scale*(self.dWs + self.rho*(self.Ws.dot(np.diag(self.mask)))),scale*self.dbs]
+        # scale grads and add L2 regularization in place, the gradient
+        # buffers are reused (and overwritten) by the next call
+        axpby(scale*self.rho,self.W1,scale,self.dW1,self.buf[0])
+        self.db1 *= scale
+        axpby(scale*self.rho,self.W2,scale,self.dW2,self.buf[2])
+        self.db2 *= scale
+        axpby(scale*self.rho,self.Ws.dot(np.diag(self.mask)),scale,self.dWs,self.buf[4])
+        self.dbs *= scale
+        return scale*cost,[self.dL,self.dW1,self.db1,self.dW2,self.db2,
+                                   self.dWs,self.dbs]
 
 
     def dropout(self, shape, p, rng=None):
@@ -246,12 +257,13 @@ class RNN2Drop:
                 dpRMS = np.sqrt(np.mean((scale*dP)**2))
                 print "weight rms=%f -- update rms=%f"%(pRMS,dpRMS)
 
-        self.stack[1:] = [P+scale*dP for P,dP in zip(self.stack[1:],update[1:])]
+        # update dense params in place, reusing the scratch buffers
+        for P,dP,buf in zip(self.stack[1:],update[1:],self.buf):
+            axpby(scale,dP,1.0,P,buf)
 
-        # handle dictionary update sparsely
-        dL = update[0]
-        for j in dL.iterkeys():
-            self.L[:,j] += scale*dL[j]
+        # handle sparse columns of L in one fancy-indexed update
+        cols,dL = update[0]
+        self.L[:,cols] += scale*dL
 
     def toFile(self,fid):
         import cPickle as pickle
@@ -264,6 +276,7 @@ class RNN2Drop:
     def check_grad(self,data,epsilon=1e-6):
 
         cost, grad = self.costAndGrad(data)
+        grad = grad[:1]+[dW.copy() for dW in grad[1:]] # buffers get reused
 
         err1 = 0.0
         count = 0.0
@@ -290,19 +303,19 @@ class RNN2Drop:
             print "Grad Check Passed for dW Sum of Error = %.12f" % (err1/count)
         else:
             print "Grad Check Failed for dW: Sum of Error = %.12f" % (err1/count)
-        # check dL separately since dict
-        dL = grad[0]
+        # check dL separately since sparse
+        cols,dL = grad[0]
         L = self.stack[0]
         err2 = 0.0
         count = 0.0
         print "Checking dL..."
-        for j in dL.iterkeys():
+        for k,j in enumerate(cols):
             for i in xrange(L.shape[0]):
                 L[i,j] += epsilon
                 costP,_ = self.costAndGrad(data)
                 L[i,j] -= epsilon
                 numGrad = (costP - cost)/epsilon
-                err = np.abs(dL[j][i] - numGrad)
+                err = np.abs(dL[i,k] - numGrad)
                 err2+=err
                 count+=1
 
@@ -1,5 +1,6 @@
 import numpy as np
 import collections
+from nn.math import columns_from_dict
 import pdb
 
 
@@ -63,11 +64,12 @@ class RNN3:
         # Back prop each tree in minibatch
         for tree in mbdata:
             self.backProp(tree.root)
+        self.dL = columns_from_dict(self.dL,self.wvecDim)
 
         # scale cost and grad by mb size
         scale = (1./self.mbSize)
-        for v in self.dL.itervalues():
-            v *=scale
+        cols,dL = self.dL
+        dL *= scale
         
         # Add L2 Regularization 
         cost += (self.rho/2)*np.sum(self.W1**2)
@@ -104,10 +106,9 @@ class RNN3:
 
         self.stack[1:] = [P+scale*dP for P,dP in zip(self.stack[1:],update[1:])]
 
-        # handle dictionary update sparsely
-        dL = update[0]
-        for j in dL.iterkeys():
-            self.L[:,j] += scale*dL[j]
+        # handle sparse columns of L in one fancy-indexed update
+        cols,dL = update[0]
+        self.L[:,cols] += scale*dL
 
     def toFile(self,fid):
         import cPickle as pickle
@@ -140,19 +141,19 @@ class RNN3:
             print "Grad Check Passed for dW"
         else:
             print "Grad Check Failed for dW: Sum of Error = %.9f" % (err1/count)
-        # check dL separately since dict
-        dL = grad[0]
+        # check dL separately since sparse
+        cols,dL = grad[0]
         L = self.stack[0]
         err2 = 0.0
         count = 0.0
         print "Checking dL..."
-        for j in dL.iterkeys():
+        for k,j in enumerate(cols):
             for i in xrange(L.shape[0]):
                 L[i,j] += epsilon
                 costP,_ = self.costAndGrad(data)
                 L[i,j] -= epsilon
                 numGrad = (costP - cost)/epsilon
-                err = np.abs(dL[j][i] - numGrad)
+                err = np.abs(dL[i,k] - numGrad)
                 err2+=err
                 count+=1
 
@@ -2,16 +2,19 @@ import numpy as np
 import collections
 np.seterr(over='raise',under='raise')
 
-from nn.math import softmax, make_onehot
+from nn.math import softmax, make_onehot, columns_from_dict, axpby
+from treebatch import TreeBatch
+
 class RNTN:
 
-    def __init__(self,wvecDim,outputDim,numWords,mbSize=30,rho=1e-6):
+    def __init__(self,wvecDim,outputDim,numWords,mbSize=30,rho=1e-6,batched=False):
         self.wvecDim = wvecDim
         self.outputDim = outputDim
         self.numWords = numWords
         self.mbSize = mbSize
         self.defaultVec = lambda : np.zeros((wvecDim,))
         self.rho = rho
+        self.batched = batched # run whole tree levels as one matrix product
 
     def initParams(self):
         np.random.seed(12341)
@@ -37,6 +40,10 @@ class RNTN:
         self.dWs = np.empty(self.Ws.shape)
         self.dbs = np.empty((self.outputDim))
 
+        # Scratch space for in-place updates, one per dense param
+        self.buf = [np.empty(P.shape) for P in self.stack[1:]]
+        self.VVt = np.empty(self.V.shape) # V + V^T of each slice, for backprop
+
     def costAndGrad(self,mbdata,test=False): 
         cost = 0.0
         correct = []
@@ -51,32 +58,48 @@ class RNTN:
         self.dbs[:] = 0
         self.dV[:] = 0
         self.dL = collections.defaultdict(self.defaultVec)
-
-        # Forward prop each tree in minibatch
-        for tree in mbdata: 
-            c,tot = self.forwardProp(tree.root,correct,guess)
-            cost += c
-            total += tot
-        if test:
-            return (1./len(mbdata))*cost,correct,guess,total
-
-        # Back prop each tree in minibatch
-        for tree in mbdata:
-            self.backProp(tree.root)
+        np.add(self.V,self.V.transpose(0,2,1),out=self.VVt)
+
+        if self.batched:
+            batch = TreeBatch(mbdata)
+            cost,total = self.forwardPropBatch(batch,correct,guess)
+            if test:
+                return (1./len(mbdata))*cost,correct,guess,total
+            self.backPropBatch(batch)
+        else:
+            # Forward prop each tree in minibatch
+            for tree in mbdata: 
+                c,tot = self.forwardProp(tree.root,correct,guess)
+                cost += c
+                total += tot
+            if test:
+                return (1./len(mbdata))*cost,correct,guess,total
+
+            # Back prop each tree in minibatch
+            for tree in mbdata:
+                self.backProp(tree.root)
+            self.dL = columns_from_dict(self.dL,self.wvecDim)
 
         # scale cost and grad by mb size
         scale = (1./self.mbSize)
-        for v in self.dL.itervalues():
-            v *=scale
+        cols,dL = self.dL
+        dL *= scale
         
         # Add L2 Regularization 
-        cost += (self.rho/2)*np.sum(self.W**2)
-        cost += (self.rho/2)*np.sum(self.Ws**2)
-        cost += (self.rho/2)*np.sum(self.V**2)
+        cost += (self.rho/2)*np.vdot(self.W,self.W)
+        cost += (self.rho/2)*np.vdot(self.Ws,self.Ws)
+        cost += (self.rho/2)*np.vdot(self.V,self.V)
         #for i in range(len(self.V)):
         #    cost += (self.rho/2)*np.sum(self.V[i])
             
-        return cost*scale, [self.dL, scale*(self.dV + self.rho*self.V),scale*(self.dW + self.rho*self.dW), scale*self.db, scale*(self.dWs+self.rho*self.Ws), scale*(self.dbs)]
+        # scale grads and add L2 regularization in place, the gradient
+        # buffers are reused (and overwritten) by the next call
+        axpby(scale*self.rho,self.V,scale,self.dV,self.buf[0])
+        axpby(scale*self.rho,self.W,scale,self.dW,self.buf[1])
+        self.db *= scale
+        axpby(scale*self.rho,self.Ws,scale,self.dWs,self.buf[3])
+        self.dbs *= scale
+        return cost*scale, [self.dL, self.dV, self.dW, self.db, self.dWs, self.dbs]
 
     def ReLU(self,x):
         #return x*(x > 0)
@@ -106,9 +129,7 @@ class RNTN:
         if node.left.fprop and node.right.fprop:
             node.fprop = True
             h = np.hstack([node.left.hActs1, node.right.hActs1])
-            tmp = np.zeros(len(node.left.hActs1))
-            for i in range(len(tmp)):
-                tmp[i] = h.dot(self.V[i]).dot(h)
+            tmp = self.tensorProd(h[None,:])[0]
             node.hActs1 = self.ReLU(self.W.dot(h) + self.b + tmp)
             node.probs = softmax(self.Ws.dot(node.hActs1)+self.bs)
             p = node.probs*make_onehot(node.label,len(self.bs))
@@ -143,15 +164,83 @@ class RNTN:
         self.dW += np.outer(errorCur,LR)
         self.db += errorCur
 
-        S = np.zeros(len(LR))
-        for i in range(len(self.V)):
-            self.dV[i] += errorCur[i]*np.outer(LR,LR)
-            S += (self.V[i]+self.V[i].T).dot(LR)*errorCur[i]
+        S = self.tensorGrad(errorCur[None,:],LR[None,:])[0]
         
         errorDown = errorCur.dot(self.W) + S        
         self.backProp(node.left,errorDown[:self.wvecDim])
         self.backProp(node.right,errorDown[self.wvecDim:])
-        
+
+    def tensorProd(self,h):
+        """
+        Bilinear term of the tensor layer for each row of h (n x 2d),
+        out[n,i] = h[n].dot(V[i]).dot(h[n]), as one GEMM against V.
+        """
+        n,D = h.shape
+        Vh = h.dot(self.V.reshape(-1,D).T).reshape(n,self.wvecDim,D)
+        return np.sum(Vh*h[:,None,:],axis=2)
+
+    def tensorGrad(self,errorCur,LR):
+        """
+        Backprop through tensorProd for each row of LR (n x 2d). Adds
+        errorCur[n,i]*outer(LR[n],LR[n]) into dV[i] and returns the
+        error reaching LR, both as GEMMs.
+        """
+        n,D = LR.shape
+        outer = (LR[:,:,None]*LR[:,None,:]).reshape(n,D*D)
+        dV = self.dV.reshape(self.wvecDim,D*D)
+        dV += errorCur.T.dot(outer)
+        VVtLR = LR.dot(self.VVt.reshape(-1,D).T).reshape(n,self.wvecDim,D)
+        return np.sum(errorCur[:,:,None]*VVtLR,axis=1)
+
+    def forwardPropBatch(self,batch,correct,guess):
+        """
+        Same as forwardProp but over a whole TreeBatch, one tree level
+        at a time. Activations live in batch.hActs1 (numNodes x wvecDim).
+        """
+        hActs1 = np.empty((batch.numNodes,self.wvecDim))
+        hActs1[batch.leaves] = self.L[:,batch.leafWords].T
+        batch.inputs = []
+        for nodes in batch.levels:
+            l,r = batch.children(nodes)
+            h = np.hstack([hActs1[l],hActs1[r]])
+            tmp = self.tensorProd(h)
+            hActs1[nodes] = self.ReLU(h.dot(self.W.T) + self.b + tmp)
+            batch.inputs.append(h)
+
+        probs = softmax(hActs1.dot(self.Ws.T) + self.bs)
+        batch.hActs1 = hActs1
+        batch.probs = probs
+
+        correct.extend(batch.labels.tolist())
+        guess.extend(np.argmax(probs,axis=1).tolist())
+        cost = -np.sum(np.log(probs[np.arange(batch.numNodes),batch.labels]))
+        return cost, batch.numNodes
+
+    def backPropBatch(self,batch):
+        """
+        Same as backProp but over a whole TreeBatch, from the highest
+        level down to the leaves.
+        """
+        errorCur = batch.probs.copy()
+        errorCur[np.arange(batch.numNodes),batch.labels] -= 1
+        self.dWs += errorCur.T.dot(batch.hActs1)
+        self.dbs += np.sum(errorCur,axis=0)
+
+        # errors from each node's softmax, children add what comes down
+        error = errorCur.dot(self.Ws)
+        for nodes,LR in reversed(zip(batch.levels,batch.inputs)):
+            errorCur = error[nodes]*self.df(batch.hActs1[nodes])
+            self.dW += errorCur.T.dot(LR)
+            self.db += np.sum(errorCur,axis=0)
+            S = self.tensorGrad(errorCur,LR)
+
+            errorDown = errorCur.dot(self.W) + S
+            l,r = batch.children(nodes)
+            error[l] += errorDown[:,:self.wvecDim]
+            error[r] += errorDown[:,self.wvecDim:]
+
+        self.dL = batch.wordGrads(error[batch.leaves])
+
 
     def updateParams(self,scale,update,log=False):
         """
@@ -166,12 +255,13 @@ class RNTN:
                 dpRMS = np.sqrt(np.mean((scale*dP)**2))
                 print "weight rms=%f -- update rms=%f"%(pRMS,dpRMS)
 
-        self.stack[1:] = [P+scale*dP for P,dP in zip(self.stack[1:],update[1:])]
+        # update dense params in place, reusing the scratch buffers
+        for P,dP,buf in zip(self.stack[1:],update[1:],self.buf):
+            axpby(scale,dP,1.0,P,buf)
 
-        # handle dictionary update sparsely
-        dL = update[0]
-        for j in dL.iterkeys():
-            self.L[:,j] += scale*dL[j]
+        # handle sparse columns of L in one fancy-indexed update
+        cols,dL = update[0]
+        self.L[:,cols] += scale*dL
 
     def toFile(self,fid):
         import cPickle as pickle
@@ -184,6 +274,7 @@ class RNTN:
     def check_grad(self,data,epsilon=1e-6):
 
         cost, grad = self.costAndGrad(data)
+        grad = grad[:1]+[dW.copy() for dW in grad[1:]] # buffers get reused
         err1 = 0.0
         count = 0.0
 
@@ -211,20 +302,20 @@ class RNTN:
             print "Grad Check Failed for dW: Sum of Error = %.12f" % (err1/count)
 
 
-        # check dL separately since dict
-        dL = grad[0]
+        # check dL separately since sparse
+        cols,dL = grad[0]
         L = self.stack[0]
         err2 = 0.0
         count = 0.0
         print "Checking dL..."
-        for j in dL.iterkeys():
+        for k,j in enumerate(cols):
             for i in xrange(L.shape[0]):
                 L[i,j] += epsilon
                 costP,_ = self.costAndGrad(data)
                 L[i,j] -= epsilon
                 numGrad = (costP - cost)/epsilon
-                err = np.abs(dL[j][i] - numGrad)
-                #print "Analytic %.9f, Numerical %.9f, Relative Error %.9f"%(dL[j][i],numGrad,err)
+                err = np.abs(dL[i,k] - numGrad)
+                #print "Analytic %.9f, Numerical %.9f, Relative Error %.9f"%(dL[i,k],numGrad,err)
                 err2+=err
                 count+=1
 
@@ -10,6 +10,7 @@ from rnn import RNN
 from rnn_changed import RNN3
 import tree as tr
 import time
+import threading
 
 import matplotlib
 matplotlib.use('Agg')
@@ -18,6 +19,9 @@ import numpy as np
 import pdb
 
 
+# models with a level-batched engine, the only ones that run on compiled trees
+BATCHED_MODELS = ('RNN','RNN2','RNTN')
+
 # This is the main training function of the codebase. You are intended to run this function via command line 
 # or by ./run.sh
 
@@ -78,6 +82,8 @@ def run(args=None):
         default="adagrad")
     parser.add_option("--epochs",dest="epochs",type="int",default=50)
     parser.add_option("--step",dest="step",type="float",default=1e-2)
+    # processes to shard each minibatch over, 1 = serial
+    parser.add_option("--workers",dest="workers",type="int",default=1)
 
 
     parser.add_option("--middleDim",dest="middleDim",type="int",default=10)
@@ -99,7 +105,12 @@ def run(args=None):
 
     parser.add_option("--model",dest="model",type="string",default="RNN")
 
+    # run every tree level of a minibatch as one matrix product (RNN, RNN2, RNTN)
+    parser.add_option("--batched",action="store_true",dest="batched",default=False)
+
     (opts,args)=parser.parse_args(args)
+    if opts.batched and opts.model not in BATCHED_MODELS:
+        parser.error("--batched is only supported for %s" % ", ".join(BATCHED_MODELS))
 
 
     # make this false if you dont care about your accuracies per epoch, makes things faster!
@@ -116,15 +127,16 @@ def run(args=None):
     dev_accuracies = []
     dev_cost = []
     # load training data
-    trees = tr.loadTrees('train')
+    # the batched engine runs on compiled trees, no linked Nodes needed
+    trees = tr.loadTrees('train',compiled=opts.batched)
     opts.numWords = len(tr.loadWordMap())
 
     if (opts.model=='RNTN'):
-        nn = RNTN(opts.wvecDim,opts.outputDim,opts.numWords,opts.minibatch)
+        nn = RNTN(opts.wvecDim,opts.outputDim,opts.numWords,opts.minibatch,batched=opts.batched)
     elif(opts.model=='RNN'):
-        nn = RNN(opts.wvecDim,opts.outputDim,opts.numWords,opts.minibatch)
+        nn = RNN(opts.wvecDim,opts.outputDim,opts.numWords,opts.minibatch,batched=opts.batched)
     elif(opts.model=='RNN2'):
-        nn = RNN2(opts.wvecDim,opts.middleDim,opts.outputDim,opts.numWords,opts.minibatch)
+        nn = RNN2(opts.wvecDim,opts.middleDim,opts.outputDim,opts.numWords,opts.minibatch,batched=opts.batched)
     elif(opts.model=='RNN2Drop'):
         nn = RNN2Drop(opts.wvecDim,opts.middleDim,opts.outputDim,opts.numWords,opts.minibatch)
     elif(opts.model=='RNN2DropMaxout'):
@@ -140,10 +152,11 @@ def run(args=None):
     nn.initParams()
 
     sgd = optimizer.SGD(nn,alpha=opts.step,minibatch=opts.minibatch,
-        optimizer=opts.optimizer)
+        optimizer=opts.optimizer,workers=opts.workers)
 
 
-    dev_trees = tr.loadTrees("dev")
+    dev_trees = tr.loadTrees("dev",compiled=opts.batched)
+    checkpoint = CheckpointWriter()
     for e in range(opts.epochs):
         start = time.time()
         print "Running epoch %d"%e
@@ -151,28 +164,29 @@ def run(args=None):
         end = time.time()
         print "Time per epoch : %f"%(end-start)
 
-        with open(opts.outFile,'w') as fid:
-            pickle.dump(opts,fid)
-            pickle.dump(sgd.costt,fid)
-            nn.toFile(fid)
+        checkpoint.save(opts.outFile,opts,sgd.costt,nn.stack)
         if evaluate_accuracy_while_training:
             print "testing on training set real quick"
-            costPerTrainEpoch, accPerTrainEpoch = test(opts.outFile,"train",opts.model,trees)
+            costPerTrainEpoch, accPerTrainEpoch, _ = evaluate(nn,trees)
+            print "Cost %f, Acc %f"%(costPerTrainEpoch,accPerTrainEpoch)
             train_accuracies.append(accPerTrainEpoch)
             train_cost.append(costPerTrainEpoch)
             
             print "testing on dev set real quick"
-            costPerDevEpoch, accPerDevEpoch = test(opts.outFile,"dev",opts.model,dev_trees)
+            costPerDevEpoch, accPerDevEpoch, _ = evaluate(nn,dev_trees)
+            print "Cost %f, Acc %f"%(costPerDevEpoch,accPerDevEpoch)
             dev_accuracies.append(accPerDevEpoch)
             dev_cost.append(costPerDevEpoch)
 
             # clear the fprop flags in trees and dev_trees
-            for tree in trees:
-                tr.leftTraverse(tree.root,nodeFn=tr.clearFprop)
-            for tree in dev_trees:
-                tr.leftTraverse(tree.root,nodeFn=tr.clearFprop)
-            print "fprop in trees cleared"
+            if not opts.batched:
+                for tree in trees:
+                    tr.leftTraverse(tree.root,nodeFn=tr.clearFprop)
+                for tree in dev_trees:
+                    tr.leftTraverse(tree.root,nodeFn=tr.clearFprop)
+                print "fprop in trees cleared"
 
+    checkpoint.wait()
 
     if evaluate_accuracy_while_training:
         pdb.set_trace()
@@ -192,20 +206,22 @@ def run(args=None):
 
 
 def test(netFile,dataSet, model='RNN', trees=None):
-    if trees==None:
-        trees = tr.loadTrees(dataSet)
     assert netFile is not None, "Must give model to test"
     print "Testing netFile %s"%netFile
-    with open(netFile,'r') as fid:
+    with open(netFile,'rb') as fid:
         opts = pickle.load(fid)
         _ = pickle.load(fid)
+        # older model files predate --batched; compiled trees only suit batched engines
+        batched = getattr(opts,'batched',False) and model in BATCHED_MODELS
+        if trees==None:
+            trees = tr.loadTrees(dataSet,compiled=batched)
         
         if (model=='RNTN'):
-            nn = RNTN(opts.wvecDim,opts.outputDim,opts.numWords,opts.minibatch)
+            nn = RNTN(opts.wvecDim,opts.outputDim,opts.numWords,opts.minibatch,batched=batched)
         elif(model=='RNN'):
-            nn = RNN(opts.wvecDim,opts.outputDim,opts.numWords,opts.minibatch)
+            nn = RNN(opts.wvecDim,opts.outputDim,opts.numWords,opts.minibatch,batched=batched)
         elif(model=='RNN2'):
-            nn = RNN2(opts.wvecDim,opts.middleDim,opts.outputDim,opts.numWords,opts.minibatch)
+            nn = RNN2(opts.wvecDim,opts.middleDim,opts.outputDim,opts.numWords,opts.minibatch,batched=batched)
         elif(model=='RNN2Drop'):
             nn = RNN2Drop(opts.wvecDim,opts.middleDim,opts.outputDim,opts.numWords,opts.minibatch)
         elif(model=='RNN2DropMaxout'):
@@ -223,21 +239,52 @@ def test(netFile,dataSet, model='RNN', trees=None):
 
     print "Testing %s..."%model
 
-    cost,correct, guess, total = nn.costAndGrad(trees,test=True)
-    correct_sum = 0
-    for i in xrange(0,len(correct)):        
-        correct_sum+=(guess[i]==correct[i])
-    
-    # TODO
-    # Plot the confusion matrix?
-
-    confuse_matrix = np.zeros((5,5))
-                              
-    for i in range(len(correct)):
-        confuse_matrix[correct[i]][guess[i]] += 1
-    print "Cost %f, Acc %f"%(cost,correct_sum/float(total))
+    cost, acc, confuse_matrix = evaluate(nn,trees)
+    print "Cost %f, Acc %f"%(cost,acc)
     makeconf(confuse_matrix,model)
-    return cost, correct_sum/float(total)
+    return cost, acc
+
+
+def evaluate(nn,trees):
+    """
+    Scores a live network on trees, no model file involved.
+    Returns cost, accuracy and the confusion matrix (truth x guess).
+    """
+    cost,correct, guess, total = nn.costAndGrad(trees,test=True)
+    correct = np.array(correct)
+    guess = np.array(guess)
+    confuse_matrix = np.zeros((nn.outputDim,nn.outputDim))
+    np.add.at(confuse_matrix,(correct,guess),1)
+    return cost, np.sum(correct==guess)/float(total), confuse_matrix
+
+
+class CheckpointWriter:
+    """
+    Pickles model checkpoints on a background thread so the epoch loop
+    does not block on disk I/O. Parameters are copied before the hand-off
+    since training keeps updating them. At most one write is in flight.
+    """
+
+    def __init__(self):
+        self.thread = None
+
+    def save(self,fname,opts,costt,stack):
+        self.wait()
+        args = (fname,opts,list(costt),[P.copy() for P in stack])
+        self.thread = threading.Thread(target=self.write,args=args)
+        self.thread.start()
+
+    def write(self,fname,opts,costt,stack):
+        # same layout as before: opts, costt, then the model stack (toFile)
+        with open(fname,'wb') as fid:
+            pickle.dump(opts,fid,pickle.HIGHEST_PROTOCOL)
+            pickle.dump(costt,fid,pickle.HIGHEST_PROTOCOL)
+            pickle.dump(stack,fid,pickle.HIGHEST_PROTOCOL)
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
 
 
 def makeconf(conf_arr,model):
@@ -1,10 +1,67 @@
 import numpy as np
 import random
+import multiprocessing
+import time
+from nn.math import sum_columns
+
+# State the forked gradient workers inherit, see SGD.run
+_worker = {}
+
+def sharedArray(A):
+    """
+    Copies A into shared memory, so forked worker processes
+    see every later in-place update of it.
+    """
+    buf = multiprocessing.RawArray('d',A.size)
+    S = np.frombuffer(buf).reshape(A.shape)
+    S[...] = A
+    return S
+
+def shardCostAndGrad(args):
+    """
+    Runs in a worker: cost and gradient of the model over trees[start:end].
+    Only one shard per minibatch adds the regularization terms.
+    """
+    start,end,regularize = args
+    model = _worker['model']
+    rho = model.rho
+    if not regularize:
+        model.rho = 0.0
+    cost,grad = model.costAndGrad(_worker['trees'][start:end])
+    model.rho = rho
+    return cost,grad
+
+def adagrad(gradt,grad,buf):
+    """
+    Adds grad.^2 to the trace gradt and rescales grad by trace.^(-1/2),
+    both in place. buf is scratch shaped like the dense params.
+    """
+    for gt,g,b in zip(gradt[1:],grad[1:],buf):
+        np.square(g,out=b)
+        gt += b
+        np.sqrt(gt,out=b)
+        g /= b
+    # handle sparse columns of L separately
+    cols,dL = grad[0]
+    gradt[0][:,cols] += dL**2
+    dL /= np.sqrt(gradt[0][:,cols])
+
+def hogwildWorker(model,trees,gradt,buf,alpha,minibatch,costs):
+    """
+    Runs in a worker process: lock-free AdaGrad over its own trees,
+    writing straight into the shared parameters and accumulators.
+    costs is a shared array with one slot per minibatch.
+    """
+    for it,i in enumerate(xrange(0,len(trees)-minibatch+1,minibatch)):
+        cost,grad = model.costAndGrad(trees[i:i+minibatch])
+        costs[it] = cost
+        adagrad(gradt,grad,buf)
+        model.updateParams(-alpha,grad,log=False)
 
 class SGD:
 
     def __init__(self,model,alpha=1e-2,minibatch=30,
-                 optimizer='sgd'):
+                 optimizer='sgd',workers=1):
         self.model = model
         print "initializing SGD"
         assert self.model is not None, "Must define a function to optimize"
@@ -12,17 +69,30 @@ class SGD:
         self.alpha = alpha # learning rate
         self.minibatch = minibatch # minibatch
         self.optimizer = optimizer
+        self.workers = workers # > 1 shards each minibatch across processes
+        if self.workers > 1 or self.optimizer == 'hogwild':
+            print "Using %d workers..."%self.workers
+            self.shared = [sharedArray(P) for P in self.model.stack]
+            self.shareParams()
         if self.optimizer == 'sgd':
             print "Using sgd.."
         elif self.optimizer == 'adagrad':
             print "Using adagrad..."
             epsilon = 1e-8
             self.gradt = [epsilon + np.zeros(W.shape) for W in self.model.stack]
+        elif self.optimizer == 'hogwild':
+            print "Using asynchronous (hogwild) adagrad..."
+            epsilon = 1e-8
+            self.gradt = [sharedArray(epsilon + np.zeros(W.shape)) for W in self.model.stack]
         else:
             raise ValueError("Invalid optimizer")
 
+        if self.optimizer != 'sgd':
+            self.buf = [np.empty(W.shape) for W in self.model.stack[1:]]
+
         self.costt = []
         self.expcost = []
+        self.treesPerSec = [] # throughput of each run
 
     def run(self,trees):
         """
@@ -35,12 +105,25 @@ class SGD:
         # randomly shuffle data
         random.shuffle(trees)
 
+        if self.optimizer == 'hogwild':
+            self.runHogwild(trees)
+            return
+
+        start = time.time()
+        if self.workers > 1:
+            # workers fork with this epoch's tree order, params are shared
+            _worker['model'] = self.model
+            _worker['trees'] = trees
+            pool = multiprocessing.Pool(self.workers)
+
         for i in xrange(0,m-self.minibatch+1,self.minibatch):
             self.it += 1
 
-            mb_data = trees[i:i+self.minibatch]
-               
-            cost,grad = self.model.costAndGrad(mb_data)
+            if self.workers > 1:
+                cost,grad = self.parallelCostAndGrad(pool,i,i+self.minibatch)
+            else:
+                mb_data = trees[i:i+self.minibatch]
+                cost,grad = self.model.costAndGrad(mb_data)
 
             # compute exponentially weighted cost
             if np.isfinite(cost):
@@ -54,26 +137,86 @@ class SGD:
                 scale = -self.alpha
 
             elif self.optimizer == 'adagrad':
-                # trace = trace+grad.^2
-                self.gradt[1:] = [gt+g**2 
-                        for gt,g in zip(self.gradt[1:],grad[1:])]
-                # update = grad.*trace.^(-1/2)
-                update =  [g*(1./np.sqrt(gt))
-                        for gt,g in zip(self.gradt[1:],grad[1:])]
-                # handle dictionary separately
-                dL = grad[0]
-                dLt = self.gradt[0]
-                for j in dL.iterkeys():
-                    dLt[:,j] = dLt[:,j] + dL[j]**2
-                    dL[j] = dL[j] * (1./np.sqrt(dLt[:,j]))
-                update = [dL] + update
+                # trace = trace+grad.^2, update = grad.*trace.^(-1/2)
+                adagrad(self.gradt,grad,self.buf)
+                update = grad
                 scale = -self.alpha
 
 
             # update params
             self.model.updateParams(scale,update,log=False)
+            if self.workers > 1:
+                self.shareParams()
 
             self.costt.append(cost)
             if self.it%100 == 0:
                 print "Iter %d : Cost=%.4f, ExpCost=%.4f."%(self.it,cost,self.expcost[-1])
+
+        if self.workers > 1:
+            pool.close()
+            pool.join()
+        self.logThroughput(m,time.time()-start)
+
+    def runHogwild(self,trees):
+        """
+        Gives each worker a disjoint part of the shuffled trees and lets
+        them all update the shared parameters without locking.
+        """
+        m = len(trees)
+        bounds = np.linspace(0,m,self.workers+1).astype(int)
+        iters = [(bounds[k+1]-bounds[k])//self.minibatch for k in range(self.workers)]
+        offsets = np.cumsum([0]+iters)
+        costs = sharedArray(np.zeros(offsets[-1]))
+
+        start = time.time()
+        procs = [multiprocessing.Process(target=hogwildWorker,
+                    args=(self.model,trees[bounds[k]:bounds[k+1]],self.gradt,self.buf,
+                          self.alpha,self.minibatch,costs[offsets[k]:offsets[k+1]]))
+                 for k in range(self.workers)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        self.logThroughput(m,time.time()-start)
+
+        for cost in costs:
+            self.it += 1
+            if np.isfinite(cost):
+                if self.it > 1:
+                    self.expcost.append(.01*cost + .99*self.expcost[-1])
+                else:
+                    self.expcost.append(cost)
+            self.costt.append(cost)
+        print "Iter %d : Cost=%.4f, ExpCost=%.4f."%(self.it,self.costt[-1],self.expcost[-1])
+
+    def logThroughput(self,m,elapsed):
+        self.treesPerSec.append(m/elapsed)
+        print "%d trees in %.2fs (%.1f trees/sec)"%(m,elapsed,self.treesPerSec[-1])
+
+    def shareParams(self):
+        """
+        Points the model back at the shared parameter arrays, copying in
+        any parameter that was rebound to a new array (e.g. by fromFile,
+        updateParams itself works in place).
+        """
+        for i,P in enumerate(self.model.stack):
+            if P is not self.shared[i]:
+                self.shared[i][...] = P
+                self.model.stack[i] = self.shared[i]
+        self.model.L = self.model.stack[0] # updateParams writes L directly
+
+    def parallelCostAndGrad(self,pool,start,end):
+        """
+        Splits trees[start:end] into one shard per worker and sums the
+        partial costs, dense gradients and sparse dL columns.
+        """
+        bounds = np.linspace(start,end,min(self.workers,end-start)+1).astype(int)
+        shards = [(bounds[k],bounds[k+1],k == 0) for k in range(len(bounds)-1)]
+        results = pool.map(shardCostAndGrad,shards)
+
+        cost = sum(c for c,_ in results)
+        grad = [sum(g[k] for _,g in results) for k in range(1,len(results[0][1]))]
+        dL = sum_columns(np.concatenate([g[0][0] for _,g in results]),
+                         np.hstack([g[0][1] for _,g in results]))
+        return cost,[dL]+grad
             
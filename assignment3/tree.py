@@ -1,5 +1,9 @@
 import collections
+import gc
+import os
+import numpy as np
 UNK = 'UNK'
+CACHE_DIR = 'cache' # binary cache of compiled trees, see loadCompiledTrees
 # This file contains the dataset in a useful way. We populate a list of Trees to train/test our Neural Nets such that each Tree contains any number of Node objects.
 
 # The best way to get a feel for how these objects are used in the program is to drop pdb.set_trace() in a few places throughout the codebase
@@ -21,13 +25,52 @@ class Node: # a node in the tree
 
 class Tree:
 
-    def __init__(self,treeString,openChar='(',closeChar=')'):
-        tokens = []
+    def __init__(self,treeString,openChar='(',closeChar=')',wordMap=None,linear=True,root=None):
         self.open = '('
         self.close = ')'
+        if root is not None: # already linked, e.g. by CompiledTree.link
+            self.root = root
+            return
+        if linear:
+            self.root = self.parseLinear(treeString,wordMap)
+            return
+        tokens = []
         for toks in treeString.strip().split():
             tokens += list(toks)
         self.root = self.parse(tokens)
+        if wordMap is not None:
+            leftTraverse(self.root,nodeFn=mapWords,args=wordMap)
+
+    def parseLinear(self,treeString,wordMap=None):
+        """
+        Single pass, stack based version of parse.
+        Each whitespace token is either an open paren with a label,
+        or a word followed by the close parens of its ancestors.
+        If wordMap is given leaves are mapped to word ids while parsing.
+        """
+        stack = []
+        root = None
+        for tok in treeString.split():
+            if tok[0] == self.open:
+                node = Node(int(tok[1:]))
+                if stack:
+                    node.parent = stack[-1]
+                    if node.parent.left is None:
+                        node.parent.left = node
+                    else:
+                        node.parent.right = node
+                stack.append(node)
+            else:
+                word = tok.rstrip(self.close)
+                node = stack[-1]
+                node.isLeaf = True
+                node.word = word.lower() # lower case?
+                if wordMap is not None:
+                    node.word = wordMap.get(node.word,wordMap[UNK])
+                for i in xrange(len(tok)-len(word)):
+                    root = stack.pop()
+        assert len(stack) == 0 and root is not None, "Malformed tree"
+        return root
 
     def parse(self, tokens, parent=None):
         assert tokens[0] == self.open, "Malformed tree"
@@ -63,6 +106,56 @@ class Tree:
 
         return node
 
+
+# rows of CompiledTree.nodes
+LEFT, RIGHT, WORD, LABEL, HEIGHT = range(5)
+
+class CompiledTree:
+    """
+    Flat form of a Tree: one (5 x numNodes) int32 array in post-order,
+    so the root is the last column. Rows are indexed by LEFT, RIGHT,
+    WORD, LABEL and HEIGHT. Leaves have LEFT = RIGHT = -1 and HEIGHT 0,
+    internal nodes have WORD = -1. Words must already be mapped to ints.
+    Can also wrap an existing nodes array (e.g. a slice of the cache).
+    """
+
+    def __init__(self,tree=None,nodes=None):
+        if nodes is None:
+            cols = []
+            self.compile(tree.root,cols)
+            nodes = np.array(cols,dtype=np.int32).T.copy()
+        self.nodes = nodes
+        self.numNodes = nodes.shape[1]
+
+    def compile(self,node,cols):
+        if node.isLeaf:
+            cols.append((-1,-1,node.word,node.label,0))
+            return len(cols)-1, 0
+        l,hl = self.compile(node.left,cols)
+        r,hr = self.compile(node.right,cols)
+        height = max(hl,hr)+1
+        cols.append((l,r,-1,node.label,height))
+        return len(cols)-1, height
+
+    def link(self):
+        """
+        Rebuilds the linked Tree of Nodes, with parent links. Post-order
+        puts children before their parent, so one pass suffices.
+        """
+        left,right,word,label = [self.nodes[r].tolist() for r in (LEFT,RIGHT,WORD,LABEL)]
+        cols = []
+        for i in xrange(self.numNodes):
+            node = Node(label[i])
+            if left[i] < 0:
+                node.isLeaf = True
+                node.word = word[i]
+            else:
+                node.left = cols[left[i]]
+                node.right = cols[right[i]]
+                node.left.parent = node.right.parent = node
+            cols.append(node)
+        return Tree(None,root=cols[-1])
+
         
 
 def leftTraverse(root,nodeFn=None,args=None):
@@ -106,10 +199,8 @@ def buildWordMap():
     """
 
     import cPickle as pickle
-    file = 'trees/train.txt'
     print "Reading trees to build word map.."
-    with open(file,'r') as fid:
-        trees = [Tree(l) for l in fid.readlines()]
+    trees = iterTrees('train')
 
     print "Counting words to give each word an index.."
     
@@ -124,18 +215,80 @@ def buildWordMap():
     with open('wordMap.bin','w') as fid:
         pickle.dump(wordMap,fid)
 
-def loadTrees(dataSet='train'):
+def iterTrees(dataSet='train',wordMap=None):
     """
-    Loads training trees. Maps leaf node words to word ids.
+    Generator over the trees of a data set, read one line at a time.
+    Leaf words are mapped to word ids if wordMap is given.
     """
-    wordMap = loadWordMap()
     file = 'trees/%s.txt'%dataSet
-    print "Loading %sing trees.."%dataSet
     with open(file,'r') as fid:
-        trees = [Tree(l) for l in fid.readlines()]
-    for tree in trees:
-        leftTraverse(tree.root,nodeFn=mapWords,args=wordMap)
-    return trees
+        for l in fid:
+            yield Tree(l,wordMap=wordMap)
+
+def loadTrees(dataSet='train',compiled=False):
+    """
+    Loads training trees. Maps leaf node words to word ids.
+    If compiled is true returns CompiledTrees instead of linked Nodes
+    (only usable by models running with batched=True). Either way the
+    trees come from the binary cache of loadCompiledTrees, so the text
+    is only parsed when the tree file or word map has changed.
+    """
+    trees = loadCompiledTrees(dataSet)
+    if compiled:
+        return trees
+    # parent links make every tree a cycle, keep the collector from
+    # rescanning the growing list of trees while linking
+    gc.disable()
+    try:
+        return [t.link() for t in trees]
+    finally:
+        gc.enable()
+
+def fileHash(fname):
+    import hashlib
+    h = hashlib.sha1()
+    with open(fname,'rb') as fid:
+        for chunk in iter(lambda: fid.read(1<<20),''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def loadCompiledTrees(dataSet='train'):
+    """
+    Loads word-mapped CompiledTrees from a binary cache in CACHE_DIR.
+    The cache holds all trees of a data set as one memory-mapped
+    (5 x numNodes) .npy buffer plus the offset of each tree in it,
+    and is keyed on the content hashes of the tree file and wordMap.bin
+    so it gets rebuilt whenever either of them changes.
+    """
+    key = fileHash('trees/%s.txt'%dataSet)[:12]+fileHash('wordMap.bin')[:12]
+    prefix = os.path.join(CACHE_DIR,'%s.%s'%(dataSet,key))
+    if not os.path.exists(prefix+'.offsets.npy'):
+        buildTreeCache(dataSet,prefix)
+    print "Loading %sing trees from %s.."%(dataSet,prefix)
+    # plain ndarray view of the map, slicing np.memmap itself is slow
+    nodes = np.load(prefix+'.nodes.npy',mmap_mode='r').view(np.ndarray)
+    offsets = np.load(prefix+'.offsets.npy')
+    return [CompiledTree(nodes=nodes[:,offsets[i]:offsets[i+1]])
+            for i in xrange(len(offsets)-1)]
+
+def buildTreeCache(dataSet,prefix):
+    print "Building tree cache %s.."%prefix
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    # drop caches built from an older tree file or word map
+    for fname in os.listdir(CACHE_DIR):
+        if fname.startswith(dataSet+'.'):
+            os.remove(os.path.join(CACHE_DIR,fname))
+
+    wordMap = loadWordMap()
+    trees = [CompiledTree(tree) for tree in iterTrees(dataSet,wordMap)]
+    nodes = np.hstack([t.nodes for t in trees])
+    offsets = np.cumsum([0]+[t.numNodes for t in trees])
+
+    # offsets are written last, a partly written cache is never picked up
+    np.save(prefix+'.nodes.npy',nodes)
+    np.save(prefix+'.offsets.tmp.npy',offsets)
+    os.rename(prefix+'.offsets.tmp.npy',prefix+'.offsets.npy')
       
 if __name__=='__main__':
     buildWordMap()
@@ -0,0 +1,54 @@
+import numpy as np
+import tree as tr
+from nn.math import sum_columns
+
+# Level-batched execution schedule for the recursive models.
+# A minibatch of trees is packed into one flat node buffer and every
+# internal node is grouped by its height (leaves are height 0). All nodes
+# of the same height only depend on lower levels, so a model can compute a
+# whole level with one matrix-matrix product instead of one matvec per node.
+
+class TreeBatch:
+
+    def __init__(self,trees):
+        """
+        Packs CompiledTrees (or Trees, compiled on the fly) into one
+        (5 x numNodes) buffer. Nodes are numbered tree after tree in
+        post-order, the order the recursive forwardProp appends to
+        correct/guess (left, right, then parent).
+        """
+        trees = [t if isinstance(t,tr.CompiledTree) else tr.CompiledTree(t)
+                 for t in trees]
+        sizes = [t.numNodes for t in trees]
+        self.nodes = np.hstack([t.nodes for t in trees])
+        self.numNodes = self.nodes.shape[1]
+
+        self.left = self.nodes[tr.LEFT] # -1 for leaves
+        self.right = self.nodes[tr.RIGHT]
+        self.words = self.nodes[tr.WORD] # -1 for internal nodes
+        self.labels = self.nodes[tr.LABEL]
+        heights = self.nodes[tr.HEIGHT]
+
+        # child indices are per tree, shift them into the packed buffer
+        offsets = np.repeat(np.cumsum([0]+sizes[:-1]),sizes)
+        internal = heights > 0
+        self.left[internal] += offsets[internal]
+        self.right[internal] += offsets[internal]
+
+        self.leaves = np.nonzero(~internal)[0]
+        self.leafWords = self.words[self.leaves]
+
+        # levels[h-1] holds the indices of all internal nodes of height h
+        order = np.argsort(heights,kind='mergesort')
+        counts = np.bincount(heights)
+        self.levels = np.split(order,np.cumsum(counts)[:-1])[1:]
+
+    def children(self,nodes):
+        return self.left[nodes], self.right[nodes]
+
+    def wordGrads(self,errLeaves):
+        """
+        Sums leaf errors (one row per leaf) that hit the same word.
+        Returns the sparse (cols, vals) gradient of L.
+        """
+        return sum_columns(self.leafWords,errLeaves.T)